@@ -20,10 +20,46 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = dbURI
 SECRET_KEY = os.environ.get('SECRET_KEY') or 'SECRET_KEY'
 app.config['SECRET_KEY'] = SECRET_KEY
+# Password hashing, new hashes use this method/cost, older ones are upgraded at login (see hash_pool.py)
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:1000000'  # Werkzeug 3.1's pbkdf2 cost
+app.config['HASH_POOL_WORKERS'] = int(os.environ.get('HASH_POOL_WORKERS') or 2)  # processes per web worker
+app.config['HASH_POOL_QUEUE'] = int(os.environ.get('HASH_POOL_QUEUE') or 16)  # waiting logins before 503
+app.config['HASH_POOL_TIMEOUT'] = 10  # seconds
+app.config['BULK_HASH_WORKERS'] = int(os.environ.get('BULK_HASH_WORKERS') or os.cpu_count() or 1)  # per web worker, shared by its imports
+app.config['BULK_IMPORTS'] = int(os.environ.get('BULK_IMPORTS') or 1)  # concurrent bulk imports per web worker before 503
+app.config['PRINCIPAL_CACHE_TTL'] = 60  # seconds a token's user/role is trusted without a lookup
+app.config['PRINCIPAL_CACHE_CHECK'] = 1  # seconds another worker's role change or removal can go unseen
+app.config['TOKEN_FLUSH_INTERVAL'] = 0.2  # seconds buffered token credits wait before they are written
+app.config['TOKEN_SNAPSHOT_INTERVAL'] = 300  # seconds between token balance snapshots
+app.config['JOKE_FLUSH_INTERVAL'] = 0.5  # seconds joke votes are counted in memory before they are written
+# Login throttling (see rate_limit.py), (tokens per second, burst)
+app.config['LOGIN_RATE_PER_IP'] = (0.5, 20)
+app.config['LOGIN_RATE_PER_UID'] = (0.1, 5)
+# '' keeps buckets per worker, a file path shares them between workers on this host
+app.config['RATE_LIMIT_STORE'] = os.environ.get('RATE_LIMIT_STORE', '')
 db = SQLAlchemy()
-Migrate(app, db)
+# GET responses shared by all workers, see response_cache.py
+app.config['RESPONSE_CACHE_PATH'] = os.path.join(app.instance_path, 'volumes', 'cache.db')
+Migrate(app, db, render_as_batch=True)  # batch mode lets SQLite alter columns
 
 # Images storage
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # maximum size of uploaded content
 app.config['UPLOAD_EXTENSIONS'] = ['.jpg', '.png', '.gif']  # supported file types
 app.config['UPLOAD_FOLDER'] = 'volumes/uploads/'  # location of user uploaded content
+app.config['MAX_IMPORT_LENGTH'] = 200 * 1024 * 1024  # maximum size of a bulk import upload
+# Outbound HTTP (see http_client.py), HTTP_CLIENT_HOSTS maps a host name to the defaults it overrides
+app.config['HTTP_CLIENT_DEFAULTS'] = {
+    'connect_timeout': 3.05, 'read_timeout': 10,  # seconds
+    'retries': 2, 'backoff': 0.5, 'max_backoff': 8,  # seconds, exponential with full jitter
+    'failure_threshold': 5, 'reset_seconds': 30,  # circuit breaker
+}
+app.config['HTTP_CLIENT_HOSTS'] = {}
+app.config['HTTP_CLIENT_POOL_HOSTS'] = 10  # hosts with pooled connections
+app.config['HTTP_CLIENT_POOL_SIZE'] = 10  # connections kept per host
+# COVID statistics upstream (see api/covid.py), the url can point at a local stub for tests
+app.config['COVID_API_URL'] = os.environ.get('COVID_API_URL') or 'https://corona-virus-world-and-india-data.p.rapidapi.com/api'
+app.config['COVID_API_KEY'] = os.environ.get('COVID_API_KEY') or 'dec069b877msh0d9d0827664078cp1a18fajsn2afac35ae063'
+app.config['COVID_REFRESH_SECONDS'] = 86400  # snapshot age that triggers a background refresh
+app.config['COVID_RETRY_SECONDS'] = 60  # wait after a failed refresh
+app.config['COVID_SNAPSHOT_PATH'] = os.path.join(app.instance_path, 'volumes', 'covid.json')
+app.config['CARD_DB_PATH'] = os.path.join(app.root_path, 'carddb.json')  # card catalog, reloaded when it changes
@@ -1,8 +1,12 @@
-from contextlib import nullcontext
-from flask import Blueprint, jsonify  # jsonify creates an endpoint response object
+from flask import Blueprint, jsonify, current_app, Response  # jsonify creates an endpoint response object
 from flask_restful import Api, Resource # used for REST API building
-import requests  # used for testing 
+import json
+import os
+import threading
 import time
+from urllib.parse import urlparse
+
+from http_client import http_client, CircuitOpen
 
 # Blueprints enable python code to be organized in multiple files and directories https://flask.palletsprojects.com/en/2.2.x/blueprints/
 covid_api = Blueprint('covid_api', __name__,
@@ -11,56 +15,151 @@ covid_api = Blueprint('covid_api', __name__,
 # API generator https://flask-restful.readthedocs.io/en/latest/api.html#id1
 api = Api(covid_api)
 
-"""Time Keeper
-Returns:
-    Boolean: is it time to update?
+"""Upstream Cache
+Stale-while-revalidate: requests are always answered from the last good snapshot, when it is older than
+COVID_REFRESH_SECONDS one background thread fetches a new one (never the request thread, never two at once).
+The snapshot is saved to COVID_SNAPSHOT_PATH, so a restarted worker serves it without a fetch, and a worker
+that finds a newer file there (saved by another worker) uses it instead of fetching again.
 """
-def updateTime():
-    global last_run  # the last_run global is preserved between calls to function
-    try: last_run
-    except: last_run = None
-    
-    # initialize last_run data
-    if last_run is None:
-        last_run = time.time()
-        return True
-    
-    # calculate time since last update
-    elapsed = time.time() - last_run
-    if elapsed > 86400:  # update every 24 hours
-        last_run = time.time()
-        return True
-    
-    return False
+# other names clients use for countries, case folded -> upstream country_name
+COUNTRY_ALIASES = {
+    "us": "USA", "united states": "USA", "united states of america": "USA", "america": "USA",
+    "united kingdom": "UK", "great britain": "UK", "britain": "UK", "england": "UK",
+    "south korea": "S. Korea", "korea": "S. Korea", "republic of korea": "S. Korea",
+    "united arab emirates": "UAE", "czech republic": "Czechia", "holland": "Netherlands",
+    "the netherlands": "Netherlands", "russian federation": "Russia", "burma": "Myanmar",
+    "cote d'ivoire": "Ivory Coast", "drc": "DRC", "democratic republic of the congo": "DRC",
+}
+
+
+# key used for country lookups: case folded, single spaces
+def countryKey(name):
+    return ' '.join(name.casefold().split())
+
+
+class Snapshot:
+    # data is the parsed upstream json, fetched the time.time() it was fetched
+    # the response bodies are serialized here, once per refresh, lookups are then one dict get
+    def __init__(self, data, fetched):
+        self.data = data
+        self.fetched = fetched
+        self.body = json.dumps(data).encode()
+        self.countries = {}  # country key or alias -> country dictionary
+        self.bodies = {}  # country key or alias -> json body
+        for country in data.get('countries_stat', []):
+            key = countryKey(country.get('country_name', ''))
+            self.countries[key] = country
+            self.bodies[key] = json.dumps(country).encode()
+        for alias, name in COUNTRY_ALIASES.items():
+            key = countryKey(name)
+            if key in self.countries and alias not in self.countries:
+                self.countries[alias] = self.countries[key]
+                self.bodies[alias] = self.bodies[key]
+
+
+class CovidUnavailable(Exception):
+    """Raised instead of fetching while a failed first fetch waits for COVID_RETRY_SECONDS"""
+
+
+class CovidCache:
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._retry_at = 0  # after a failed fetch, no new attempt before this time
+
+    def _stale(self, snapshot):
+        return time.time() - snapshot.fetched > current_app.config['COVID_REFRESH_SECONDS']
+
+    # returns Snapshot or None when there is no usable file
+    def _read_file(self, path):
+        try:
+            with open(path) as snapshot_file:
+                saved = json.load(snapshot_file)
+            return Snapshot(saved['data'], saved['fetched'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_file(self, path, snapshot):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as snapshot_file:
+            json.dump({'fetched': snapshot.fetched, 'data': snapshot.data}, snapshot_file)
+        os.replace(temporary, path)  # readers see the old or the new file, never half of one
+
+    # newer snapshot from the file, or a fetch from upstream, swapped in and saved
+    def _refresh(self, app):
+        path = app.config['COVID_SNAPSHOT_PATH']
+        saved = self._read_file(path)
+        if saved is not None and (self._snapshot is None or saved.fetched > self._snapshot.fetched) \
+                and time.time() - saved.fetched <= app.config['COVID_REFRESH_SECONDS']:
+            self._snapshot = saved  # refreshed by another worker
+            return
+        response = http_client.get(app.config['COVID_API_URL'], headers={
+            'x-rapidapi-key': app.config['COVID_API_KEY'],
+            'x-rapidapi-host': urlparse(app.config['COVID_API_URL']).hostname,
+        })
+        response.raise_for_status()
+        data = response.json()
+        if not isinstance(data, dict) or not isinstance(data.get('countries_stat'), list):
+            raise ValueError('unexpected upstream payload, no countries_stat list')
+        snapshot = Snapshot(data, time.time())
+        self._snapshot = snapshot
+        self._write_file(path, snapshot)
+
+    def _background(self, app):
+        try:
+            self._refresh(app)
+        except CircuitOpen as e:
+            self._retry_at = time.time() + app.config['COVID_RETRY_SECONDS']
+            app.logger.warning(f'covid refresh skipped, serving the previous snapshot: {e}')
+        except Exception:
+            self._retry_at = time.time() + app.config['COVID_RETRY_SECONDS']
+            app.logger.exception('covid refresh failed, serving the previous snapshot')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    # nothing to serve yet and a fetch failed less than COVID_RETRY_SECONDS ago
+    def _unavailable(self):
+        if self._snapshot is None and time.time() < self._retry_at:
+            raise CovidUnavailable(f'upstream failed, next attempt in {int(self._retry_at - time.time()) + 1} seconds')
+
+    # returns Snapshot, raises when nothing was ever fetched and the upstream fails
+    # (CovidUnavailable, without calling the upstream, until COVID_RETRY_SECONDS after the failure)
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            self._unavailable()
+            with self._lock:  # first use in this worker: file, else one fetch while the others wait
+                if self._snapshot is None:
+                    self._snapshot = self._read_file(current_app.config['COVID_SNAPSHOT_PATH'])
+                self._unavailable()  # the fetch the others waited for failed
+                if self._snapshot is None:
+                    try:
+                        self._refresh(current_app._get_current_object())
+                    except Exception:
+                        self._retry_at = time.time() + current_app.config['COVID_RETRY_SECONDS']
+                        raise
+                snapshot = self._snapshot
+        if self._stale(snapshot) and time.time() >= self._retry_at:
+            with self._lock:
+                start = not self._refreshing
+                self._refreshing = True
+            if start:
+                threading.Thread(target=self._background, args=(current_app._get_current_object(),),
+                                 name='covid-refresh', daemon=True).start()
+        return snapshot
+
+
+covid_cache = CovidCache()
 
 """API Handler
 Returns:
-    String: API response
+    Dictionary: last upstream response
 """   
 def getCovidAPI():
-    global covid_data  # the covid_data global is preserved between calls to function
-    try: covid_data
-    except: covid_data = None
-
-    """
-    Preserve Service usage / speed time with a Reasonable refresh delay
-    """
-    if updateTime(): # request Covid data
-        """
-        RapidAPI is the world's largest API Marketplace. 
-        Developers use Rapid API to discover and connect to thousands of APIs. 
-        """
-        url = "https://corona-virus-world-and-india-data.p.rapidapi.com/api"
-        headers = {
-            'x-rapidapi-key': "dec069b877msh0d9d0827664078cp1a18fajsn2afac35ae063",
-            'x-rapidapi-host': "corona-virus-world-and-india-data.p.rapidapi.com"
-        }
-        response = requests.request("GET", url, headers=headers)
-        covid_data = response
-    else:  # Request Covid Data
-        response = covid_data
-
-    return response
+    return covid_cache.get().data
 
 
 """API with Country Filter
@@ -68,13 +167,10 @@ Returns:
     String: Filter of API response
 """   
 def getCountry(filter):
-    # Request Covid Data
-    response = getCovidAPI()
-    # Look for Country    
-    countries = response.json().get('countries_stat')
-    for country in countries:  # countries is a list
-        if country["country_name"].lower() == filter.lower():  # this filters for country
-            return country
+    # Look for Country, by name or alias
+    country = covid_cache.get().countries.get(countryKey(filter))
+    if country is not None:
+        return country
     
     return {"message": filter + " not found"}
 
@@ -86,12 +182,23 @@ class CovidAPI:
     """API Method to GET all Covid Data"""
     class _Read(Resource):
         def get(self):
-            return getCovidAPI().json()
+            try:
+                snapshot = covid_cache.get()
+            except Exception as e:
+                return {'message': f'Covid data unavailable: {e}'}, 503
+            return Response(snapshot.body, mimetype='application/json')
         
     """API Method to GET Covid Data for a Specific Country"""
     class _ReadCountry(Resource):
         def get(self, filter):
-            return jsonify(getCountry(filter))
+            try:
+                snapshot = covid_cache.get()
+            except Exception as e:
+                return {'message': f'Covid data unavailable: {e}'}, 503
+            body = snapshot.bodies.get(countryKey(filter))  # serialized at refresh, no json work here
+            if body is None:
+                return jsonify({"message": filter + " not found"})
+            return Response(body, mimetype='application/json')
     
     # resource is called an endpoint: base usr + prefix + endpoint
     api.add_resource(_Read, '/')
@@ -107,12 +214,15 @@ if __name__ == "__main__":
     There were at least 10 debugging session, on handling updateTime.
     """
     
+    from __init__ import app
+    app.app_context().push()
+
     print("-"*30) # cosmetic separator
 
     # This code looks for "world data"
-    response = getCovidAPI()
+    data = getCovidAPI()
     print("World Totals")
-    world = response.json().get('world_total')  # turn response to json() so we can extract "world_total"
+    world = data.get('world_total')  # turn response to json() so we can extract "world_total"
     for key, value in world.items():  # this finds key, value pairs in country
         print(key, value)
 
@@ -1,10 +1,16 @@
 import json, jwt,re
 from flask import Blueprint, request, jsonify, current_app, Response
 from flask_restful import Api, Resource # used for REST API building
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, date
 from auth_middleware import token_required
+from cache_middleware import conditional
+from api.listing import list_response, MAX_LIMIT
+from api.uploads import importRows, validateEvent
 
-from model.users import Event
+from __init__ import db
+from model.users import Event, searchEvents, nearbyEvents, eventCalendar, insertEvents, updateEvents
+from model.zipcodes import zipcodeLocation
 
 event_api = Blueprint('event_api', __name__,
                    url_prefix='/api/events')
@@ -12,6 +18,62 @@ event_api = Blueprint('event_api', __name__,
 # API docs https://flask-restful.readthedocs.io/en/latest/api.html
 api = Api(event_api)
 
+# Open events (no userID) matching the filters in args (query string or json body)
+# -- title, description, address: contains; zipcode, agegroup: equals; from, to: date range
+# returns (query, None) or (None, error message)
+def filterEvents(args):
+    # Construct a dynamic WHERE clause based on user input
+    filters = {}
+    title_filter = args.get('title')
+    if title_filter:
+        filters['title'] = title_filter
+    description_filter = args.get('description')
+    if description_filter:
+        filters['description'] = description_filter
+    address_filter = args.get('address')
+    if address_filter:
+        filters['address'] = address_filter
+    zipcode_filter = args.get('zipcode')
+    if zipcode_filter:
+        if not str(zipcode_filter).isdigit():
+            return None, f'zipcode must be a whole number'
+        filters['zipcode'] = int(zipcode_filter)
+    agegroup_filter = args.get('agegroup')
+    if agegroup_filter:
+        if not str(agegroup_filter).isdigit():
+            return None, f'agegroup must be a whole number'
+        filters['agegroup'] = int(agegroup_filter)
+    # date range, both ends included
+    for field in ('from', 'to'):
+        date_filter = args.get(field)
+        if date_filter:
+            try:
+                filters[field] = datetime.strptime(date_filter, '%Y-%m-%d').date()
+            except (TypeError, ValueError):
+                return None, f'{field} date format error {date_filter}, must be yyyy-mm-dd'
+
+    # Build the query dynamically
+    query = Event.query.filter(Event.userID.is_(None))
+    
+    for field, value in filters.items():
+        if field == 'zipcode':
+            query = query.filter(Event.zipcode == value)
+        elif field == 'agegroup':
+            query = query.filter(Event.agegroup == value)
+        elif field == 'from':
+            query = query.filter(Event.date >= value)
+        elif field == 'to':
+            query = query.filter(Event.date <= value)
+        else:
+            query = query.filter(getattr(Event, field).like(f'%{value}%'))
+    return query, None
+
+
+IMPORT_BATCH_SIZE = 5000  # rows per INSERT transaction
+MAX_PATCHES = 10000  # events changed by one bulk PATCH
+MAX_USERS_PER_LOOKUP = 500  # ids accepted by /by_users, keeps the IN list under SQLite's variable limit
+
+
 class EventAPI:        
     class _CRUD(Resource):  # Event API operation for Create, Read.
         @token_required
@@ -20,39 +82,13 @@ class EventAPI:
             body = request.get_json()
             
             ''' Avoid garbage in, error checking '''
-            # validate title
-            title = body.get('title')
-            if title is None or len(title) < 2:
-                return {'message': f'Title is missing, or is less than 2 characters'}, 400
-            description = body.get('description')
-            if description is None or len(description) < 2:
-                return {'message': f'Description is missing, or is less than 2 characters'}, 400
-            address = body.get('address')
-            if address is None or len(address) < 2:
-                return {'message': f'Address is missing, or is less than 2 characters'}, 400
-            agegroup = body.get('agegroup')
-            if agegroup is None or len(agegroup) < 2:
-                return {'message': f'Age Group is missing, or is less than 2 characters'}, 400
-            
-            # validate zip code
-            zipcode = body.get('zipcode')
-            if zipcode is None or bool(re.match(r'^\d{5}$', zipcode)) == False :
-                return {'message': f'Zip code is missing, or invalid. Zip code must be 5 digits'}, 400
-            # look for event date
-            date = body.get('date')
-            if date is not None:
-                try:
-                    eventdate = datetime.strptime(date, '%Y-%m-%d').date()
-                except:
-                    return {'message': f'Event Date format error {date}, must be yyyy-mm-dd'}, 400
-                if eventdate <= datetime.now().date():
-                    return {'message': f'Event Date cannot be in the past'}, 400
-            else:
-                return {'message': f'Event Date is missing'}, 400
-                
+            fields, message = validateEvent(body)
+            if message:
+                return {'message': message}, 400
+            title = fields['title']
 
             ''' #1: Key code block, setup Event OBJECT '''
-            event = Event(title=title,description=description,address=address, zipcode=zipcode, date=eventdate, agegroup=agegroup)
+            event = Event(**fields)
 
             # create event in database
             event = event.create()
@@ -63,10 +99,10 @@ class EventAPI:
             return {'message': f'Error creating {title}'}, 400
 
         
+        @conditional('events')
         def get(self): # Read Method
-            events = Event.query.all()    # read/extract all events from database
-            json_ready = [event.read() for event in events]  # prepare output in json
-            return jsonify(json_ready)  # jsonify creates Flask response object, more specific to APIs than json.dumps
+            # pages with ?after=&limit=, otherwise streams every event in chunks
+            return list_response(Event.query, Event.id, Event.read, fields=Event.READ_FIELDS)
 
 
         def put(self):
@@ -74,9 +110,44 @@ class EventAPI:
             id = body.get('id') # get the UID (Know what to reference)
             data = body.get('data')
             event = Event.query.get(id) # get the player (using the uid in this case)
-            event.update(data)
+            try:
+                event.update(data)
+            except (TypeError, ValueError) as e:  # bad date, agegroup or unknown zipcode, as updateEvents reports it
+                return {'message': f'Invalid data: {e}'}, 400
             return f"{event.read()} Updated"
         
+        @token_required
+        def patch(self, current_user):
+            # bulk update in one transaction, either
+            # {"patches": [{"id": 1, "data": {...}}, ...]} or {"filter": {same as /query}, "data": {...}}
+            body = request.get_json()
+            patches = body.get('patches')
+            if patches is not None:
+                if not isinstance(patches, list) or not all(
+                        isinstance(patch, dict) and isinstance(patch.get('id'), int) and isinstance(patch.get('data'), dict)
+                        for patch in patches):
+                    return {'message': f'patches must be a list of {{"id": <int>, "data": {{...}}}}'}, 400
+                # results are per id, and which of two changes to one event wins would depend on their order
+                duplicates = sorted(id for id, count in Counter(patch['id'] for patch in patches).items() if count > 1)
+                if duplicates:
+                    return {'message': f'Each event id may appear once in patches, repeated: {duplicates}'}, 400
+                patches = [(patch['id'], patch['data']) for patch in patches]
+            else:
+                filter = body.get('filter')
+                data = body.get('data')
+                if not isinstance(filter, dict) or not isinstance(data, dict):
+                    return {'message': f'Body needs patches, or a filter and data'}, 400
+                query, message = filterEvents(filter)
+                if message:
+                    return {'message': message}, 400
+                patches = [(id, data) for (id,) in query.with_entities(Event.id).limit(MAX_PATCHES + 1)]
+            if len(patches) > MAX_PATCHES:
+                return {'message': f'At most {MAX_PATCHES} events can be changed per request'}, 400
+
+            results = updateEvents(patches)
+            updated = sum(1 for result in results.values() if result == 'updated')
+            return jsonify({'updated': updated, 'results': {str(id): result for id, result in results.items()}})
+
         @token_required
         def delete(self, current_user):
             body = request.get_json()
@@ -87,48 +158,143 @@ class EventAPI:
     
     
     class _FILTER(Resource):
+        @conditional('events')
         def get(self):
-            # Construct a dynamic WHERE clause based on user input
-            filters = {}
-            title_filter = request.args.get('title')
-            if title_filter:
-                filters['title'] = title_filter
-            description_filter = request.args.get('description')
-            if description_filter:
-                filters['description'] = description_filter
-            address_filter = request.args.get('address')
-            if address_filter:
-                filters['address'] = address_filter
-            zipcode_filter = request.args.get('zipcode')
-            if zipcode_filter:
-                filters['zipcode'] = int(zipcode_filter)
-
-            # Build the query dynamically
-            query = Event.query.filter(Event.userID.is_(None))
-            
-            for field, value in filters.items():
-                if field == 'zipcode':
-                    query = query.filter(Event.zipcode == value)
-                else:
-                    query = query.filter(getattr(Event, field).like(f'%{value}%'))
+            query, message = filterEvents(request.args)
+            if message:
+                return {'message': message}, 400
 
-            # Execute the query
-            results = query.all()
+            # Execute the query, paged or streamed
+            return list_response(query, Event.id, Event.read, fields=Event.READ_FIELDS)
 
-            json_ready = [event.read() for event in results]  # prepare output in json
-            return jsonify(json_ready)  # jsonify creates Flask response object, more specific to APIs than json.dumps              
+    class _IMPORT(Resource):
+        @token_required
+        def post(self, current_user):
+            # bulk create from a csv or ndjson upload, rows use the same fields and rules as POST /api/events/
+            if request.mimetype not in ('text/csv', 'application/x-ndjson'):
+                return {'message': f'Upload must be text/csv or application/x-ndjson'}, 415
+            request.max_content_length = current_app.config['MAX_IMPORT_LENGTH']
+
+            inserted = 0
+            errors = []
+            batch = []
+            batch_numbers = []
+
+            def flush():
+                nonlocal inserted
+                try:
+                    inserted += insertEvents(batch)
+                except Exception as e:
+                    db.session.rollback()
+                    errors.extend({'row': number, 'message': f'Not saved: {e}'} for number in batch_numbers)
+                batch.clear()
+                batch_numbers.clear()
+
+            for number, row, error in importRows():
+                if error is None:
+                    try:
+                        row, error = validateEvent(row)
+                    except TypeError:
+                        row, error = None, f'Fields must be strings'
+                if error:
+                    errors.append({'row': number, 'message': error})
+                    continue
+                batch.append(row)
+                batch_numbers.append(number)
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    flush()
+            flush()
+
+            return jsonify({'inserted': inserted, 'failed': len(errors), 'errors': errors})
+
+    class _SEARCH(Resource):
+        @conditional('events')
+        def get(self):
+            # ranked full-text search of open events, ?q=food bank matches words starting with food and bank
+            q = request.args.get('q')
+            if q is None or len(q.strip()) < 1:
+                return {'message': f'Search text q is missing'}, 400
+            limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_LIMIT)
+            offset = max(request.args.get('offset', 0, type=int), 0)
+            events = searchEvents(q, limit=limit, offset=offset)
+            return jsonify([event.read() for event in events])
+
+    class _NEARBY(Resource):
+        @conditional('events')
+        def get(self):
+            # open events within ?miles= (default 25) of ?zipcode=, nearest first
+            zipcode = request.args.get('zipcode')
+            if zipcode is None or bool(re.match(r'^\d{5}$', zipcode)) == False:
+                return {'message': f'Zip code is missing, or invalid. Zip code must be 5 digits'}, 400
+            location = zipcodeLocation(zipcode)
+            if location is None:
+                return {'message': f'Zip code {zipcode} is not in the zipcode table'}, 404
+            try:
+                miles = float(request.args.get('miles', 25))
+            except ValueError:
+                return {'message': f'miles must be a number'}, 400
+            if not 0 < miles <= 500:
+                return {'message': f'miles must be more than 0 and at most 500'}, 400
+            limit = min(max(request.args.get('limit', 50, type=int), 1), MAX_LIMIT)
+
+            json_ready = []
+            for event, distance in nearbyEvents(location[0], location[1], miles, limit=limit):
+                item = event.read()
+                item['distance'] = round(distance, 1)
+                json_ready.append(item)
+            return jsonify(json_ready)
+
+    class _CALENDAR(Resource):
+        @conditional('events')
+        def get(self):
+            # per-day counts of open events for ?year=&month=, defaults to the current month
+            today = date.today()
+            year = request.args.get('year', today.year, type=int)
+            month = request.args.get('month', today.month, type=int)
+            if not 1 <= month <= 12 or not 1 <= year <= 9999:
+                return {'message': f'year and month must be a valid year and 1 to 12'}, 400
+            agegroup = request.args.get('agegroup')
+            if agegroup is not None and not agegroup.isdigit():
+                return {'message': f'agegroup must be a whole number'}, 400
+            days = eventCalendar(year, month, int(agegroup) if agegroup is not None else None)
+            return jsonify({'year': year, 'month': month, 'days': days})
 
     class _GETBYID(Resource):
+        @conditional('events')
         def get(self, id):
-            events = Event.query.filter(Event.userID.is_(id)).all()    # read/extract all events from database
-            json_ready = [event.read() for event in events]  # prepare output in json
-            return jsonify(json_ready)  # jsonify creates Flask response object, more specific to APIs than json.dumps
+            query = Event.query.filter(Event.userID == id)    # events of one user
+            return list_response(query, Event.id, Event.read, fields=Event.READ_FIELDS)
+
+
+    class _BYUSERS(Resource):
+        @conditional('events')
+        def get(self):
+            # events of many users in one query, ?ids=1,2,3 returns {"1": [...], "2": [...], "3": [...]}
+            ids = request.args.get('ids')
+            if ids is None or len(ids) < 1:
+                return {'message': f'ids is missing, expected comma separated user ids'}, 400
+            try:
+                ids = sorted({int(id) for id in ids.split(',') if id.strip()})
+            except ValueError:
+                return {'message': f'ids must be comma separated integers'}, 400
+            if len(ids) > MAX_USERS_PER_LOOKUP:
+                return {'message': f'At most {MAX_USERS_PER_LOOKUP} ids per request'}, 400
 
+            grouped = {str(id): [] for id in ids}  # users without events get an empty list
+            events = Event.query.filter(Event.userID.in_(ids)).order_by(Event.userID, Event.id)  # uses ix_events_user_date
+            for event in events:
+                grouped[str(event.userID)].append(event.read())
+            return jsonify(grouped)
 
     # building RESTapi endpoint
     api.add_resource(_CRUD, '/')
     api.add_resource(_FILTER, '/query')
+    api.add_resource(_IMPORT, '/import')
+    api.add_resource(_SEARCH, '/search')
+    api.add_resource(_NEARBY, '/nearby')
+    api.add_resource(_CALENDAR, '/calendar')
     api.add_resource(_GETBYID, '/get_by_id/<int:id>')
+    api.add_resource(_BYUSERS, '/by_users')
     
 
 
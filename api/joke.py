@@ -1,4 +1,4 @@
-from flask import Blueprint, jsonify  # jsonify creates an endpoint response object
+from flask import Blueprint, jsonify, request  # jsonify creates an endpoint response object
 from flask_restful import Api, Resource # used for REST API building
 import requests  # used for testing 
 import random
@@ -11,6 +11,16 @@ joke_api = Blueprint('joke_api', __name__,
 # API generator https://flask-restful.readthedocs.io/en/latest/api.html#id1
 api = Api(joke_api)
 
+MAX_TOP = 100  # most jokes a top list returns
+
+# Read ?top=N from the query string
+# returns (N, None) or (None, error response)
+def topArg():
+    top = request.args.get('top', '10')
+    if not top.isdigit() or not 1 <= int(top) <= MAX_TOP:
+        return None, ({'message': f'top must be a whole number between 1 and {MAX_TOP}'}, 400)
+    return int(top), None
+
 class JokesAPI:
     # not implemented
     class _Create(Resource):
@@ -25,6 +35,8 @@ class JokesAPI:
     # getJoke(id)
     class _ReadID(Resource):
         def get(self, id):
+            if id >= countJokes():
+                return {'message': f'Joke {id} not found'}, 404
             return jsonify(getJoke(id))
 
     # getRandomJoke()
@@ -42,15 +54,35 @@ class JokesAPI:
     # put method: addJokeHaHa
     class _UpdateLike(Resource):
         def put(self, id):
+            if id >= countJokes():
+                return {'message': f'Joke {id} not found'}, 404
             addJokeHaHa(id)
             return jsonify(getJoke(id))
 
     # put method: addJokeBooHoo
     class _UpdateJeer(Resource):
         def put(self, id):
+            if id >= countJokes():
+                return {'message': f'Joke {id} not found'}, 404
             addJokeBooHoo(id)
             return jsonify(getJoke(id))
 
+    # likedJokes(top)
+    class _ReadLiked(Resource):
+        def get(self):
+            top, error = topArg()
+            if error:
+                return error
+            return jsonify(likedJokes(top))
+
+    # jeeredJokes(top)
+    class _ReadJeered(Resource):
+        def get(self):
+            top, error = topArg()
+            if error:
+                return error
+            return jsonify(jeeredJokes(top))
+
     # building RESTapi resources/interfaces, these routes are added to Web Server
     api.add_resource(_Create, '/create/<string:joke>')
     api.add_resource(_Read, '/')
@@ -59,6 +91,8 @@ class JokesAPI:
     api.add_resource(_ReadCount, '/count')
     api.add_resource(_UpdateLike, '/like/<int:id>')
     api.add_resource(_UpdateJeer, '/jeer/<int:id>')
+    api.add_resource(_ReadLiked, '/liked')
+    api.add_resource(_ReadJeered, '/jeered')
     
 if __name__ == "__main__": 
     # server = "http://127.0.0.1:5000" # run local
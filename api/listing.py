@@ -0,0 +1,130 @@
+""" Helpers shared by the collection (list) endpoints
+
+Keyset pagination: ?after=<id>&limit=<n> returns rows with id > after, ordered by id,
+the id to continue from is returned in the X-Next-Cursor header.
+Streaming: without a limit, or with ?format=ndjson (Accept: application/x-ndjson),
+rows are read from the database in chunks and encoded as they are sent,
+so worker memory stays flat no matter how big the table is.
+Projection: ?fields=id,title returns only those keys, and only their columns are SELECTed.
+"""
+from flask import request, jsonify, current_app, Response, stream_with_context
+from sqlalchemy.orm import load_only
+
+NDJSON = 'application/x-ndjson'
+CHUNK_SIZE = 500   # rows read per SELECT while streaming
+MAX_LIMIT = 1000   # largest page a client can ask for
+
+
+# Read ?after=&limit= from the query string
+# returns (after, limit), raises ValueError with a client message on bad input
+def page_args(default_limit=None):
+    after = request.args.get('after')
+    limit = request.args.get('limit')
+    try:
+        after = int(after) if after is not None else None
+    except ValueError:
+        raise ValueError(f'after must be an integer id, got {after}')
+    try:
+        limit = int(limit) if limit is not None else default_limit
+    except ValueError:
+        raise ValueError(f'limit must be an integer, got {limit}')
+    if limit is not None and not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f'limit must be between 1 and {MAX_LIMIT}')
+    return after, limit
+
+
+# Read ?fields=a,b from the query string, allowed is the model's READ_FIELDS
+# returns list of field names or None for all fields, raises ValueError on unknown fields
+def field_args(allowed):
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    fields = list(dict.fromkeys(field.strip() for field in fields.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in allowed]
+    if unknown or not fields:
+        raise ValueError(f'Unknown fields {", ".join(unknown)}, choose from {", ".join(allowed)}')
+    return fields
+
+
+# Query loading only the columns the fields need, plus the id used as cursor
+def project(query, model, allowed, fields):
+    columns = {'id'} | {column for field in fields for column in allowed[field]}
+    return query.options(load_only(*(getattr(model, column) for column in columns)))
+
+
+# True when the client asked for newline delimited json
+def wants_ndjson():
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+
+# One page of rows after the cursor, reads limit + 1 rows to know if there is more
+# returns (rows, next_after) where next_after is None on the last page
+def keyset_page(query, key, after, limit):
+    if after is not None:
+        query = query.filter(key > after)
+    rows = query.order_by(key).limit(limit + 1).all()
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+# Generator over all rows after the cursor, one SELECT per chunk
+# each chunk restarts from the last id seen, so no cursor is held open between chunks
+def iter_keyset(query, key, after=None, limit=None, chunk_size=CHUNK_SIZE):
+    sent = 0
+    while limit is None or sent < limit:
+        size = chunk_size if limit is None else min(chunk_size, limit - sent)
+        chunk = (query.filter(key > after) if after is not None else query).order_by(key).limit(size).all()
+        for row in chunk:
+            yield row
+        if len(chunk) < size:
+            return
+        sent += len(chunk)
+        after = chunk[-1].id
+
+
+def _ndjson_lines(rows, serialize):
+    dumps = current_app.json.dumps  # same encoding (dates etc.) as jsonify
+    for row in rows:
+        yield dumps(serialize(row)) + '\n'
+
+
+def _json_array(rows, serialize):
+    dumps = current_app.json.dumps
+    yield '['
+    first = True
+    for row in rows:
+        yield ('' if first else ',') + dumps(serialize(row))
+        first = False
+    yield ']\n'
+
+
+# Build the response for a list endpoint from an (unordered) query
+# key is the unique, indexed column used as cursor, serialize turns a row into a dict
+# fields is the model's READ_FIELDS to support ?fields=, serialize is then called as serialize(row, fields)
+def list_response(query, key, serialize, default_limit=None, fields=None):
+    try:
+        after, limit = page_args(default_limit)
+        selected = field_args(fields) if fields else None
+    except ValueError as e:
+        return {'message': str(e)}, 400
+    if selected:
+        query = project(query, key.class_, fields, selected)
+        read = serialize
+        serialize = lambda row: read(row, selected)
+
+    if wants_ndjson():
+        rows = iter_keyset(query, key, after, limit)
+        return Response(stream_with_context(_ndjson_lines(rows, serialize)), mimetype=NDJSON)
+
+    if limit is None:  # whole collection, same json array as before but streamed in chunks
+        rows = iter_keyset(query, key, after)
+        return Response(stream_with_context(_json_array(rows, serialize)), mimetype='application/json')
+
+    rows, next_after = keyset_page(query, key, after, limit)
+    response = jsonify([serialize(row) for row in rows])
+    if next_after is not None:
+        response.headers['X-Next-Cursor'] = str(next_after)
+    return response
@@ -1,7 +1,10 @@
 from flask import Blueprint, request, jsonify
 from flask_restful import Api, Resource # used for REST API building
 
-from model.players import Player
+from cache_middleware import conditional
+from api.listing import list_response, MAX_LIMIT
+from model.players import Player, TokenEntry, leaderboard
+from model.ledger import increment, transfer, token_buffer, checkBalance, NotEnoughTokens
 
 # Change variable name and API name and prefix
 player_api = Blueprint('player_api', __name__,
@@ -48,10 +51,10 @@ class PlayerAPI:
             # failure returns error
             return {'message': f'Processed {name}, either a format error or User ID {uid} is duplicate'}, 210
 
+        @conditional('players')
         def get(self):
-            players = Player.query.all()    # read/extract all players from database
-            json_ready = [player.read() for player in players]  # prepare output in json
-            return jsonify(json_ready)  # jsonify creates Flask response object, more specific to APIs than json.dumps
+            # ?fields=id,name,tokens selects only those columns, ?after=&limit= pages
+            return list_response(Player.query, Player.id, Player.read, fields=Player.READ_FIELDS)
 
         def put(self):
             body = request.get_json() # get the body of the request
@@ -69,5 +72,99 @@ class PlayerAPI:
             return f"{player.read()} Has been deleted"
 
 
+    class _Leaderboard(Resource):
+        @conditional('players')
+        def get(self):
+            # ?top=N players with the most tokens, with their rank
+            top = request.args.get('top', '10')
+            if not top.isdigit() or not 1 <= int(top) <= MAX_LIMIT:
+                return {'message': f'top must be a whole number between 1 and {MAX_LIMIT}'}, 400
+            return jsonify(leaderboard.top(int(top)))
+
+    class _Rank(Resource):
+        @conditional('players')
+        def get(self, uid):
+            rank = leaderboard.rank(uid)
+            if rank is None:
+                return {'message': f'Player {uid} not found'}, 404
+            return jsonify(rank)
+
+    class _Tokens(Resource):
+        def post(self, uid):
+            # {"delta": n, "reason": "..."} adds n (may be negative) tokens and answers the new balance
+            # "buffered": true queues a credit (n > 0) that is written within a moment, answers 202
+            body = request.get_json()
+            delta = body.get('delta')
+            reason = body.get('reason')
+            if not isinstance(delta, int) or isinstance(delta, bool) or delta == 0:
+                return {'message': f'delta must be a non zero whole number'}, 400
+            if reason is not None and (not isinstance(reason, str) or len(reason) > 64):
+                return {'message': f'reason must be text of at most 64 characters'}, 400
+            player = Player.query.filter_by(_uid=uid).first()
+            if player is None:
+                return {'message': f'Player {uid} not found'}, 404
+            if body.get('buffered'):
+                if delta < 0:
+                    return {'message': f'Only credits (delta > 0) can be buffered'}, 400
+                token_buffer.credit(player.id, delta, reason)
+                return {'message': f'{delta} tokens queued for {uid}'}, 202
+            try:
+                tokens = increment(player.id, delta, reason)
+            except NotEnoughTokens as e:
+                return {'message': str(e)}, 409
+            except LookupError as e:
+                return {'message': str(e)}, 404
+            return jsonify({'uid': uid, 'tokens': tokens})
+
+    class _Transfer(Resource):
+        def post(self):
+            # {"from": uid, "to": uid, "amount": n, "reason": "..."} moves n tokens in one transaction
+            body = request.get_json()
+            amount = body.get('amount')
+            reason = body.get('reason')
+            if not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+                return {'message': f'amount must be a whole number above 0'}, 400
+            if reason is not None and (not isinstance(reason, str) or len(reason) > 64):
+                return {'message': f'reason must be text of at most 64 characters'}, 400
+            players = {}
+            for side in ('from', 'to'):
+                uid = body.get(side)
+                players[side] = Player.query.filter_by(_uid=uid).first() if uid else None
+                if players[side] is None:
+                    return {'message': f'Player {uid} not found'}, 404
+            if players['from'].id == players['to'].id:
+                return {'message': f'Cannot transfer to the same player'}, 400
+            try:
+                payer, payee = transfer(players['from'].id, players['to'].id, amount, reason)
+            except NotEnoughTokens as e:
+                return {'message': str(e)}, 409
+            except LookupError as e:
+                return {'message': str(e)}, 404
+            return jsonify({body['from']: payer, body['to']: payee})
+
+    class _Ledger(Resource):
+        @conditional('players')
+        def get(self, uid):
+            # ledger entries of one player, oldest first, ?after=&limit= pages
+            player = Player.query.filter_by(_uid=uid).first()
+            if player is None:
+                return {'message': f'Player {uid} not found'}, 404
+            return list_response(TokenEntry.query.filter_by(playerID=player.id), TokenEntry.id, TokenEntry.read)
+
+    class _Balance(Resource):
+        def get(self, uid):
+            # stored balance checked against the ledger
+            player = Player.query.filter_by(_uid=uid).first()
+            if player is None:
+                return {'message': f'Player {uid} not found'}, 404
+            return jsonify({'uid': uid, **checkBalance(player)})
+
+
     # building RESTapi endpoint, method distinguishes action
     api.add_resource(Action, '/')
+    api.add_resource(_Leaderboard, '/leaderboard')
+    api.add_resource(_Rank, '/<string:uid>/rank')
+    api.add_resource(_Tokens, '/<string:uid>/tokens')
+    api.add_resource(_Transfer, '/transfer')
+    api.add_resource(_Ledger, '/<string:uid>/ledger')
+    api.add_resource(_Balance, '/<string:uid>/balance')
@@ -1,12 +1,11 @@
-from contextlib import nullcontext
-from flask import Blueprint, jsonify  # jsonify creates an endpoint response object
+from flask import Blueprint, request, jsonify, Response
 from flask_restful import Api, Resource # used for REST API building
-import time
-from flask import Blueprint, request, jsonify
-import json
-import requests
 import random
-from flask import request
+
+from cache_middleware import conditional
+from api.listing import list_response
+from model.cards import getCatalog, CatalogError
+from model.reviews import Review, RATINGS, reviewSummary
 
 reviews_api = Blueprint('reviews_api', __name__,
                   url_prefix='/api/reviews')
@@ -14,63 +13,89 @@ reviews_api = Blueprint('reviews_api', __name__,
 # API docs https://flask-restful.readthedocs.io/en/latest/api.html
 api = Api(reviews_api)
 
-def beautify_json_data(json_file_path):
-    try:
-        with open(json_file_path, 'r') as json_file:
-            data = json.load(json_file)
-
-        beautified_data = []
-        for item in data.get('items', []):
-            beautified_item = {
-                "name": item.get("name", ""),
-                "maxLevel": item.get("maxLevel", 0),
-            }
-
-            medium_icon_url = item.get("iconUrls", {}).get("medium", "")
-            if medium_icon_url:
-                beautified_item["medium"] = medium_icon_url
-
-            beautified_data.append(beautified_item)
-
-        return beautified_data  # Return the processed data as a list
+SEARCH_LIMIT = 10  # typeahead suggestions when no limit is given
+MAX_SEARCH_LIMIT = 100
+REVIEWS_PAGE_SIZE = 20  # reviews per page when no limit is given
 
-    except FileNotFoundError:
-        return {"error": "File not found"}
-    except json.JSONDecodeError:
-        return {"error": "Invalid JSON format in the file"}
 
-
-beautify_json_data("carddb.json")
+# Response for a body prebuilt by the catalog, revalidated with the catalog's ETag
+def catalog_response(catalog, body):
+    response = Response(body, mimetype='application/json')
+    response.set_etag(catalog.etag)
+    return response.make_conditional(request)
 
 
 # getJokes()
 class _Read(Resource):
     def get(self):
-        json_list = []
-        json_list.append(beautify_json_data('carddb.json'))
-        return jsonify(json_list)
+        try:
+            catalog = getCatalog()
+        except CatalogError as e:
+            return {"error": str(e)}, 500
+        return catalog_response(catalog, catalog.read_body)
 
 class _ReadRandom(Resource):
     def get(self):
-        beautified_data = beautify_json_data('carddb.json')
-        random_item = random.choice(beautified_data)
-        return jsonify(random_item)
+        try:
+            catalog = getCatalog()
+        except CatalogError as e:
+            return {"error": str(e)}, 500
+        return Response(random.choice(catalog.card_bodies), mimetype='application/json')
     
 class _Search(Resource):
     def get(self):
+        # typeahead: ?query=arch&limit=10, name prefix matches first, then substring, then one typo away
         query = request.args.get('query')  # Get the query parameter
         if not query:
             return {"error": "No query provided"}, 400
-
-        beautified_data = beautify_json_data('carddb.json')
-        results = [item for item in beautified_data if query.lower() in item['name'].lower()]
-
-        return jsonify(results)
+        limit = request.args.get('limit', str(SEARCH_LIMIT))
+        if not limit.isdigit() or not 1 <= int(limit) <= MAX_SEARCH_LIMIT:
+            return {"error": f"limit must be a whole number between 1 and {MAX_SEARCH_LIMIT}"}, 400
+        try:
+            catalog = getCatalog()
+        except CatalogError as e:
+            return {"error": str(e)}, 500
+        return catalog_response(catalog, catalog.search(query, int(limit)))
 
 class _Count(Resource):
     def get(self):
-        beautified_data = beautify_json_data('carddb.json')
-        count = len(beautified_data)
-        return {"count": count}
-
+        try:
+            catalog = getCatalog()
+        except CatalogError as e:
+            return {"error": str(e)}, 500
+        return catalog_response(catalog, catalog.count_body)
+
+class _TitleReviews(Resource):
+    @conditional('reviews')
+    def get(self, title):
+        # reviews of one title, oldest first, ?after=&limit= pages
+        return list_response(Review.query.filter_by(title=title), Review.id, Review.read,
+                             default_limit=REVIEWS_PAGE_SIZE)
+
+    def post(self, title):
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return {'message': f'Body must be a JSON object with review and rating'}, 400
+        review = body.get('review')
+        if not isinstance(review, str) or len(review) < 2:
+            return {'message': f'Review is missing, not text, or is less than 2 characters'}, 400
+        rating = body.get('rating')
+        if not isinstance(rating, int) or isinstance(rating, bool) or rating not in RATINGS:
+            return {'message': f'Rating must be a whole number from {RATINGS[0]} to {RATINGS[-1]}'}, 400
+        return jsonify(Review(title=title, review=review, rating=rating).create().read())
+
+class _TitleSummary(Resource):
+    @conditional('reviews')
+    def get(self, title):
+        # count, average and histogram of ratings, read from the review_stats aggregate
+        summary = reviewSummary(title)
+        if summary is None:
+            return {'message': f'No reviews for {title}'}, 404
+        return jsonify(summary)
+
+api.add_resource(_Read, '/')
 api.add_resource(_ReadRandom, '/random')
+api.add_resource(_Search, '/search')
+api.add_resource(_Count, '/count')
+api.add_resource(_TitleReviews, '/titles/<string:title>')
+api.add_resource(_TitleSummary, '/titles/<string:title>/summary')
@@ -0,0 +1,70 @@
+""" Helpers shared by the endpoints that create rows from uploads (api/event.py, api/user.py)
+
+-- validateEvent checks one event, from a json body, a csv row or the events of an imported user
+-- importRows reads a text/csv or application/x-ndjson request body a line at a time,
+   so an upload of any size is never held in memory at once
+"""
+import csv, io, json, re
+from datetime import datetime
+from flask import request
+
+from model.zipcodes import zipcodeLocation
+
+
+# Checks an event body (json dictionary or csv row) is complete and well formed
+# returns (fields for the Event constructor, None) or (None, error message)
+def validateEvent(body):
+    title = body.get('title')
+    if title is None or len(title) < 2:
+        return None, f'Title is missing, or is less than 2 characters'
+    description = body.get('description')
+    if description is None or len(description) < 2:
+        return None, f'Description is missing, or is less than 2 characters'
+    address = body.get('address')
+    if address is None or len(address) < 2:
+        return None, f'Address is missing, or is less than 2 characters'
+    agegroup = body.get('agegroup')
+    if agegroup is None or not str(agegroup).isdigit():
+        return None, f'Age Group is missing, or is not a whole number'
+
+    # validate zip code
+    zipcode = body.get('zipcode')
+    if zipcode is None or bool(re.match(r'^\d{5}$', str(zipcode))) == False :
+        return None, f'Zip code is missing, or invalid. Zip code must be 5 digits'
+    if zipcodeLocation(zipcode) is None:
+        return None, f'Zip code {zipcode} is not a known US zip code'
+    # look for event date
+    date = body.get('date')
+    if date is not None:
+        try:
+            eventdate = datetime.strptime(date, '%Y-%m-%d').date()
+        except:
+            return None, f'Event Date format error {date}, must be yyyy-mm-dd'
+        if eventdate <= datetime.now().date():
+            return None, f'Event Date cannot be in the past'
+    else:
+        return None, f'Event Date is missing'
+
+    return dict(title=title, description=description, address=address, zipcode=zipcode, date=eventdate, agegroup=agegroup), None
+
+
+# Parses the request body a line at a time, text/csv with a header row or application/x-ndjson
+# yields (row number, dictionary or None, parse error or None)
+def importRows():
+    stream = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8-sig', newline='')
+    if request.mimetype == 'text/csv':
+        for number, row in enumerate(csv.DictReader(stream), start=1):
+            yield number, row, None
+        return
+    for number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield number, None, f'Invalid json: {e.msg}'
+            continue
+        if not isinstance(row, dict):
+            yield number, None, f'Each line must be a json object'
+            continue
+        yield number, row, None
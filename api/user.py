@@ -1,10 +1,17 @@
 import json, jwt
-from flask import Blueprint, request, jsonify, current_app, Response
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
 from flask_restful import Api, Resource # used for REST API building
 from datetime import datetime
 from auth_middleware import token_required
+from cache_middleware import conditional
+from api.listing import list_response, NDJSON
+from api.uploads import importRows, validateEvent
 
-from model.users import User
+from __init__ import db
+from model.users import User, existingUids, insertUsers
+from hash_pool import PoolSaturated, bulk_hash_pool
+from rate_limit import loginRetryAfter
+from sqlalchemy.orm import selectinload, undefer
 
 user_api = Blueprint('user_api', __name__,
                    url_prefix='/api/users')
@@ -12,6 +19,52 @@ user_api = Blueprint('user_api', __name__,
 # API docs https://flask-restful.readthedocs.io/en/latest/api.html
 api = Api(user_api)
 
+USERS_PAGE_SIZE = 50  # users per page when no limit is given
+USER_IMPORT_BATCH_SIZE = 200  # users hashed and inserted per transaction, one progress line each
+
+# Checks a user row of a bulk import (json dictionary or csv row)
+# events is optional, a list of events (a json array string in csv) checked like POST /api/events/
+# returns (users columns with the plain password, None) or (None, error message)
+def validateUser(row):
+    name = row.get('name')
+    if name is None or len(name) < 2:
+        return None, f'Name is missing, or is less than 2 characters'
+    uid = row.get('uid')
+    if uid is None or len(uid) < 2:
+        return None, f'User ID is missing, or is less than 2 characters'
+    password = row.get('password')
+    if not password:
+        return None, f'Password is missing'
+    dob = row.get('dob')
+    if dob:
+        try:
+            dob = datetime.strptime(dob, '%Y-%m-%d').date()
+        except:
+            return None, f'Date of birth format error {dob}, must be yyyy-mm-dd'
+    else:
+        dob = datetime.today().date()
+    role = row.get('role') or 'User'
+    if role not in ('User', 'Admin'):
+        return None, f'Role must be User or Admin'
+
+    events = row.get('events') or []
+    if isinstance(events, str):
+        try:
+            events = json.loads(events)
+        except json.JSONDecodeError as e:
+            return None, f'Events must be a json array: {e.msg}'
+    if not isinstance(events, list) or not all(isinstance(event, dict) for event in events):
+        return None, f'Events must be a list of objects'
+    valid_events = []
+    for number, event in enumerate(events, start=1):
+        fields, message = validateEvent(event)
+        if message:
+            return None, f'Event {number}: {message}'
+        valid_events.append(fields)
+
+    return dict(_name=name, _uid=uid, _password=password, _dob=dob, _role=role, events=valid_events), None
+
+
 class UserAPI:        
     class _CRUD(Resource):  # User API operation for Create, Read.  THe Update, Delete methods need to be implemeented
         
@@ -57,10 +110,21 @@ class UserAPI:
             return {'message': f'Processed {name}, either a format error or User ID {uid} is duplicate'}, 400
 
         
+        @conditional('users', 'events')
         def get(self): # Read Method
-            users = User.query.all()    # read/extract all users from database
-            json_ready = [user.read() for user in users]  # prepare output in json
-            return jsonify(json_ready)  # jsonify creates Flask response object, more specific to APIs than json.dumps
+            # pages of users (?after=&limit=), each with its event_count
+            # ?embed=events lists the events instead, ?fields=id,name selects only those columns
+            fields = request.args.get('fields')
+            embed_events = request.args.get('embed') == 'events' or 'events' in (fields or '').split(',')
+            query = User.query
+            if embed_events:
+                query = query.options(selectinload(User.events))  # events of the whole page in one SELECT ... IN
+            elif not fields:
+                query = query.options(undefer(User.event_count))  # count computed inside the users SELECT
+            default = [field for field in User.DEFAULT_FIELDS if field != 'events'] + \
+                      ['events' if embed_events else 'event_count']
+            read = lambda user, fields=None: user.read(fields or default)
+            return list_response(query, User.id, read, default_limit=USERS_PAGE_SIZE, fields=User.READ_FIELDS)
 
 
         @token_required
@@ -80,6 +144,82 @@ class UserAPI:
             user.delete()
             return f"{user.read()} Has been deleted"
     
+    class _IMPORT(Resource):
+        @token_required
+        def post(self, current_user):
+            # bulk create from a csv or ndjson upload: name, uid, password, dob, role, events
+            # answers ndjson, one line per row error and one progress line per batch, then a summary line
+            if request.mimetype not in ('text/csv', 'application/x-ndjson'):
+                return {'message': f'Upload must be text/csv or application/x-ndjson'}, 415
+            request.max_content_length = current_app.config['MAX_IMPORT_LENGTH']
+            dumps = current_app.json.dumps
+            try:
+                bulk_hash_pool.begin()
+            except PoolSaturated as e:
+                return {'message': f'{e}, try again later'}, 503, {'Retry-After': '60'}
+
+            def progress():
+                counts = {'processed': 0, 'inserted': 0, 'failed': 0}
+                seen = set()  # uids earlier in this upload
+                batch = []
+
+                def error(number, message):
+                    counts['failed'] += 1
+                    return dumps({'row': number, 'message': message}) + '\n'
+
+                # hashes and inserts the batch, yields its output lines
+                # raises PoolSaturated when passwords can no longer be hashed, the import stops
+                def flush():
+                    taken = existingUids(row['_uid'] for number, row in batch)
+                    for number, row in batch:
+                        if row['_uid'] in taken:
+                            yield error(number, f"User ID {row['_uid']} is duplicate")
+                    rows = [(number, row) for number, row in batch if row['_uid'] not in taken]
+                    batch.clear()
+                    try:
+                        hashes = bulk_hash_pool.hashPasswords([row['_password'] for number, row in rows])
+                    except PoolSaturated as e:
+                        for number, row in rows:
+                            yield error(number, f'Not saved: {e}')
+                        raise
+                    try:
+                        for (number, row), pwhash in zip(rows, hashes):
+                            row['_password'] = pwhash
+                        counts['inserted'] += insertUsers([row for number, row in rows])
+                    except Exception as e:
+                        db.session.rollback()
+                        for number, row in rows:
+                            yield error(number, f'Not saved: {e}')
+                    yield dumps(counts) + '\n'
+
+                try:
+                    for number, row, message in importRows():
+                        counts['processed'] += 1
+                        if message is None:
+                            try:
+                                row, message = validateUser(row)
+                            except TypeError:
+                                row, message = None, f'Fields must be strings'
+                        if message is None and row['_uid'] in seen:
+                            message = f"User ID {row['_uid']} is repeated in the upload"
+                        if message:
+                            yield error(number, message)
+                            continue
+                        seen.add(row['_uid'])
+                        batch.append((number, row))
+                        if len(batch) >= USER_IMPORT_BATCH_SIZE:
+                            yield from flush()
+                    if batch:
+                        yield from flush()
+                except PoolSaturated as e:
+                    yield dumps({**counts, 'done': False, 'message': f'Import stopped, {e}: rows after {number} were not read'}) + '\n'
+                    return
+                yield dumps({**counts, 'done': True}) + '\n'
+
+            response = Response(stream_with_context(progress()), mimetype=NDJSON)
+            response.call_on_close(bulk_hash_pool.end)
+            return response
+
     class _Security(Resource):
         def post(self):
             try:
@@ -95,11 +235,21 @@ class UserAPI:
                 if uid is None:
                     return {'message': f'User ID is missing'}, 400
                 password = body.get('password')
+
+                ''' Throttle before any password hashing '''
+                retry_after = loginRetryAfter(uid, request.remote_addr)
+                if retry_after:
+                    return {'message': f"Too many login attempts, try again in {retry_after} seconds"}, 429, {'Retry-After': str(retry_after)}
                 
                 ''' Find user '''
                 user = User.query.filter_by(_uid=uid).first()
-                if user is None or not user.is_password(password):
-                    return {'message': f"Invalid user id or password"}, 400
+                try:
+                    if user is None or not user.is_password(password):
+                        return {'message': f"Invalid user id or password"}, 400
+                except PoolSaturated:
+                    # every hashing process is busy (or the hash timed out), fail fast rather than queue
+                    return {'message': f"Too many logins in progress, try again shortly"}, 503, {'Retry-After': '1'}
+                user.rehash_password(password)
                 if user:
                     try:
                         token = jwt.encode(
@@ -138,4 +288,5 @@ class UserAPI:
     # building RESTapi endpoint
     api.add_resource(_CRUD, '/')
     api.add_resource(_Security, '/authenticate')
+    api.add_resource(_IMPORT, '/import')
     
\ No newline at end of file
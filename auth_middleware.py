@@ -1,8 +1,10 @@
 from functools import wraps
+import time
 import jwt
 from flask import request, abort
 from flask import current_app
 from model.users import User
+from principal_cache import principal_cache, Principal
 
 def token_required(f):
     @wraps(f)
@@ -15,16 +17,23 @@ def token_required(f):
                 "error": "Unauthorized"
             }, 401
         try:
-            data=jwt.decode(token, current_app.config["SECRET_KEY"], algorithms=["HS256"])
-            current_user=User.query.filter_by(_uid=data["_uid"]).first()
-            current_role=current_user.role
+            # principals of recently seen tokens are cached, skipping the users lookup
+            current_user = principal_cache.get(token)
             if current_user is None:
-                return {
-                "message": "Invalid Authentication token!",
-                "data": None,
-                "error": "Unauthorized"
-            }, 401
-            if current_role != 'Admin':
+                data=jwt.decode(token, current_app.config["SECRET_KEY"], algorithms=["HS256"])
+                user=User.query.filter_by(_uid=data["_uid"]).first()
+                if user is None:
+                    return {
+                    "message": "Invalid Authentication token!",
+                    "data": None,
+                    "error": "Unauthorized"
+                }, 401
+                current_user = Principal(id=user.id, uid=user.uid, name=user.name, role=user.role)
+                ttl = current_app.config["PRINCIPAL_CACHE_TTL"]
+                if "exp" in data:  # never cache past the token's own expiry
+                    ttl = min(ttl, data["exp"] - time.time())
+                principal_cache.set(token, current_user, ttl)
+            if current_user.role != 'Admin':
                 return {
                 "message": "Invalid Access token!",
                 "data": None,
@@ -0,0 +1,42 @@
+from functools import wraps
+import hashlib
+from flask import request, Response
+from model.versions import getVersions
+from response_cache import response_cache
+
+MAX_CACHED_BODY = 1024 * 1024  # larger or streamed responses are not cached
+SKIPPED_HEADERS = {'Content-Type', 'Content-Length', 'Set-Cookie'}
+
+# Conditional GET for collection endpoints, the ETag is derived from the table versions
+# -- If-None-Match with the current ETag answers 304 before any row is read
+# -- otherwise the body is served from the shared response cache when another request
+#    (in any worker) already built it for the same versions
+# -- tables are every table the response is built from, e.g. users embed events
+def conditional(*tables):
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            versions = getVersions(*tables)
+            key = f"{request.full_path}|{request.headers.get('Accept', '')}|{versions}"
+            etag = hashlib.sha1(key.encode()).hexdigest()[:20]
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            elif (cached := response_cache.get(etag)) is not None:
+                response = Response(cached[0], mimetype=cached[1], headers=cached[2])
+            else:
+                response = f(*args, **kwargs)
+                if not isinstance(response, Response) or response.status_code != 200:
+                    return response  # errors are not cached
+                if not response.is_streamed:
+                    body = response.get_data()
+                    if len(body) <= MAX_CACHED_BODY:
+                        headers = {name: value for name, value in response.headers.items() if name not in SKIPPED_HEADERS}
+                        response_cache.set(etag, body, response.mimetype, tables, headers)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'  # always revalidate, 304 is cheap
+            response.vary.add('Accept')
+            return response
+
+        return decorated
+
+    return decorator
@@ -0,0 +1,197 @@
+""" Password hashing on a bounded process pool, away from the request threads
+
+pbkdf2 is CPU bound, a login spike would otherwise pin every web worker and starve cheap GETs.
+-- HASH_POOL_WORKERS processes do the hashing
+-- at most HASH_POOL_QUEUE more requests wait for a process, beyond that PoolSaturated is raised
+   right away so the API can answer 503 instead of queueing without bound; a hash still not done
+   after HASH_POOL_TIMEOUT seconds raises PoolSaturated too
+-- a pool broken by a dead process (OOM kill, crash) is replaced, the hash is tried once more on the new one
+-- PASSWORD_HASH_METHOD is the cost new hashes get, needsRehash() tells when a stored hash is weaker
+-- bulk imports hash on a pool of their own (bulk_hash_pool), so they never make logins answer 503;
+   BULK_HASH_WORKERS processes per web worker shared by at most BULK_IMPORTS imports at a time,
+   another import is refused with PoolSaturated rather than adding processes
+"""
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import multiprocessing
+import os
+import threading
+import time
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from __init__ import app
+from process_local import ProcessLocal
+
+
+class PoolSaturated(Exception):
+    """Raised when more hashes are waiting than the pool accepts"""
+
+
+class HashPool:
+    def __init__(self, workers=None, queue_depth=None):
+        self._workers = workers
+        self._queue_depth = queue_depth
+        self._pool = ProcessLocal(self._start)  # (executor, slots) of this web worker
+
+    @property
+    def workers(self):
+        return self._workers or app.config['HASH_POOL_WORKERS']
+
+    @property
+    def queue_depth(self):
+        return self._queue_depth if self._queue_depth is not None else app.config['HASH_POOL_QUEUE']
+
+    # one pool per web worker process, created on first use (never inherited through fork)
+    # processes are forked from a single threaded fork server, not from the threaded web worker
+    def _start(self):
+        context = multiprocessing.get_context('forkserver')
+        return (ProcessPoolExecutor(self.workers, mp_context=context),
+                threading.BoundedSemaphore(self.workers + self.queue_depth))
+
+    # drops a pool whose process died, the next run() starts a new one
+    def _replace(self, pool):
+        if self._pool.discard(pool):
+            pool[0].shutdown(wait=False, cancel_futures=True)
+            app.logger.warning('password hash pool broken by a dead process, replaced')
+
+    # runs fn(*args) in the pool and waits for it, once more on a new pool when the pool broke
+    # raises PoolSaturated when no slot is free, the result takes longer than HASH_POOL_TIMEOUT
+    # or the new pool broke too
+    def run(self, fn, *args):
+        for attempt in range(2):
+            pool = self._pool.get()
+            executor, slots = pool
+            if not slots.acquire(blocking=False):
+                raise PoolSaturated(f'{self.workers + self.queue_depth} password hashes already in progress')
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                slots.release()
+                self._replace(pool)
+                continue
+            except Exception:
+                slots.release()
+                raise
+            future.add_done_callback(lambda future, slots=slots: slots.release())
+            try:
+                return future.result(timeout=app.config['HASH_POOL_TIMEOUT'])
+            except TimeoutError:
+                raise PoolSaturated(f'password hash not done after {app.config["HASH_POOL_TIMEOUT"]} seconds')
+            except BrokenProcessPool:
+                self._replace(pool)
+        raise PoolSaturated('password hash processes keep dying')
+
+    def verify(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    def generate(self, password):
+        return self.run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'], 10)
+
+    def shutdown(self):
+        pool = self._pool.reset()
+        if pool is not None:
+            pool[0].shutdown()
+
+
+hash_pool = HashPool()
+
+
+# method of a hash ('pbkdf2:sha256:1000000', 'scrypt:32768:8:1', ...) as (family, cost)
+# cost is None for methods that are never strong enough: unknown, plain digests, pbkdf2 over md5/sha1
+def _strength(method):
+    family, *params = method.split(':')
+    try:
+        if family == 'pbkdf2' and len(params) == 2 and params[0] not in ('md5', 'sha1'):
+            return family, int(params[1])  # iterations
+        if family == 'scrypt' and len(params) == 3:
+            return family, int(params[0]) * int(params[1])  # n * r, work and memory
+    except ValueError:
+        pass
+    return family, None
+
+
+# True when the stored hash is weaker than PASSWORD_HASH_METHOD: lower cost of the same family,
+# or a method with no known cost; hashes of another family or of a higher cost are kept
+def needsRehash(pwhash):
+    family, cost = _strength(pwhash.split('$', 1)[0])
+    target_family, target_cost = _strength(app.config['PASSWORD_HASH_METHOD'])
+    return cost is None or (family == target_family and cost < target_cost)
+
+
+class BulkHashPool:
+    def __init__(self):
+        self._pool = ProcessLocal(self._start)  # executor of this web worker, kept between imports
+        self._imports = ProcessLocal(lambda: threading.BoundedSemaphore(app.config['BULK_IMPORTS']))
+
+    def _start(self):
+        context = multiprocessing.get_context('forkserver')
+        return ProcessPoolExecutor(app.config['BULK_HASH_WORKERS'], mp_context=context)
+
+    # drops a pool whose process died, the next hashPasswords() starts a new one
+    def _replace(self, pool):
+        if self._pool.discard(pool):
+            pool.shutdown(wait=False, cancel_futures=True)
+            app.logger.warning('bulk hash pool broken by a dead process, replaced')
+
+    # takes an import slot, raises PoolSaturated when BULK_IMPORTS imports are running; end() gives it back
+    def begin(self):
+        if not self._imports.get().acquire(blocking=False):
+            raise PoolSaturated(f'{app.config["BULK_IMPORTS"]} bulk imports already in progress')
+
+    def end(self):
+        self._imports.get().release()
+
+    # Hashes passwords across the processes of the pool, once more on a new pool when the pool broke
+    # returns list of hashes in the order of passwords, raises PoolSaturated when the new pool broke too
+    def hashPasswords(self, passwords):
+        generate = partial(generate_password_hash, method=app.config['PASSWORD_HASH_METHOD'], salt_length=10)
+        for attempt in range(2):
+            pool = self._pool.get()
+            try:
+                # a chunk of 4 is about a second of pbkdf2, cheap to ship and small enough to keep workers balanced
+                return list(pool.map(generate, passwords, chunksize=4))
+            except BrokenProcessPool:
+                self._replace(pool)
+        raise PoolSaturated('password hash processes keep dying')
+
+    def shutdown(self):
+        pool = self._pool.reset()
+        if pool is not None:
+            pool.shutdown()
+
+
+bulk_hash_pool = BulkHashPool()
+
+
+"""Benchmark
+  python hash_pool.py [logins]
+  reports verifications (logins) per second on the request thread and through the pool, per core
+"""
+if __name__ == "__main__":
+    import sys
+
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    method = app.config['PASSWORD_HASH_METHOD']
+    pwhash = generate_password_hash('123toby', method, 10)
+    print(f"{method}, {logins} logins")
+
+    start = time.perf_counter()
+    for _ in range(logins):
+        check_password_hash(pwhash, '123toby')
+    inline = logins / (time.perf_counter() - start)
+    print(f"request thread: {inline:8.1f} logins/sec (1 core)")
+
+    cores = os.cpu_count() or 1
+    pool = HashPool(workers=cores, queue_depth=logins)
+    pool.verify(pwhash, '123toby')  # start the worker processes outside the timing
+    start = time.perf_counter()
+    threads = [threading.Thread(target=pool.verify, args=(pwhash, '123toby')) for _ in range(logins)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pooled = logins / (time.perf_counter() - start)
+    print(f"pool x{cores}:      {pooled:8.1f} logins/sec, {pooled / cores:8.1f} per core")
+    pool.shutdown()
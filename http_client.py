@@ -0,0 +1,237 @@
+""" Outbound HTTP client shared by integrations (api/covid.py, ...)
+
+-- one requests.Session per worker process: connections (and TLS sessions) are pooled and reused
+-- every request has a timeout, (connect, read) seconds per host, HTTP_CLIENT_HOSTS overrides HTTP_CLIENT_DEFAULTS
+-- idempotent requests are retried on connection errors, timeouts, broken bodies and 429/502/503/504,
+   at most retries times, sleeping a random ("full jitter") share of an exponential backoff
+-- a circuit breaker per host opens after failure_threshold failures in a row: requests then fail at once
+   with CircuitOpen for reset_seconds, after which one trial request decides whether it closes again
+-- latency and outcomes are kept per host, see metrics()
+"""
+from collections import deque
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from __init__ import app
+from process_local import ProcessLocal
+
+RETRY_STATUSES = {429, 502, 503, 504}
+# transport failures worth another attempt, others (InvalidURL, TooManyRedirects, ...) are raised at once
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a host whose circuit breaker is open"""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.failures = 0  # in a row
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    # True when a request may go out, in half-open state only the one trial request may;
+    # a trial with no outcome after reset_seconds is given up and another one goes out
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if time.time() - self.opened_at >= self.reset_seconds:  # open, or half-open with a lost trial
+                self.state = 'half-open'
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.time()
+
+
+class LatencyStats:
+    def __init__(self, window=500):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.retries = 0
+        self.rejected = 0  # failed fast by the circuit breaker
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=window)  # latencies for the percentiles
+
+    def record(self, seconds, failed):
+        with self._lock:
+            self.requests += 1
+            self.failures += failed
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self._recent.append(seconds)
+
+    # outcome is 'retries' or 'rejected'
+    def count(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    # returns dictionary of counts and latencies in milliseconds
+    def read(self):
+        with self._lock:
+            recent = sorted(self._recent)
+            percentile = lambda share: round(recent[min(len(recent) - 1, int(len(recent) * share))] * 1000, 1) \
+                if recent else None
+            return {
+                "requests": self.requests,
+                "failures": self.failures,
+                "retries": self.retries,
+                "rejected": self.rejected,
+                "avg_ms": round(self.total / self.requests * 1000, 1) if self.requests else None,
+                "p50_ms": percentile(0.5),
+                "p95_ms": percentile(0.95),
+                "max_ms": round(self.max * 1000, 1),
+            }
+
+
+class HttpClient:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = ProcessLocal(self._pooled)
+        self._breakers = {}  # host -> CircuitBreaker
+        self._stats = {}  # host -> LatencyStats
+
+    # pooled session, one per process (never shared through fork)
+    def _pooled(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=app.config['HTTP_CLIENT_POOL_HOSTS'],
+                              pool_maxsize=app.config['HTTP_CLIENT_POOL_SIZE'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    # settings of host, HTTP_CLIENT_DEFAULTS updated with its HTTP_CLIENT_HOSTS entry
+    def policy(self, host):
+        return {**app.config['HTTP_CLIENT_DEFAULTS'], **app.config['HTTP_CLIENT_HOSTS'].get(host, {})}
+
+    def _host(self, host, policy):
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(policy['failure_threshold'], policy['reset_seconds'])
+                self._stats[host] = LatencyStats()
+            return self._breakers[host], self._stats[host]
+
+    # seconds to wait before retry number attempt (0 based)
+    def _backoff(self, policy, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit() and int(retry_after) <= policy['max_backoff']:
+            return int(retry_after)
+        return random.uniform(0, min(policy['max_backoff'], policy['backoff'] * 2 ** attempt))
+
+    # requests.request with pooling, timeouts, retries and the circuit breaker of the url's host
+    # returns requests.Response (any status, after retries), raises CircuitOpen or requests.RequestException
+    def request(self, method, url, **kwargs):
+        host = urlparse(url).hostname
+        policy = self.policy(host)
+        breaker, stats = self._host(host, policy)
+        session = self._session.get()
+        kwargs.setdefault('timeout', (policy['connect_timeout'], policy['read_timeout']))
+        retries = policy['retries'] if method.upper() in IDEMPOTENT_METHODS else 0
+
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                stats.count('rejected')
+                raise CircuitOpen(f'{host} is failing, not called for {policy["reset_seconds"]} seconds')
+            start = time.perf_counter()
+            response = error = None
+            try:
+                response = session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                error = e
+            except BaseException:  # not a requests error, still the outcome of this attempt
+                stats.record(time.perf_counter() - start, True)
+                breaker.failure()
+                raise
+            failed = error is not None or response.status_code >= 500 or response.status_code == 429
+            stats.record(time.perf_counter() - start, failed)
+            if failed:
+                breaker.failure()
+            else:
+                breaker.success()
+            if error is not None:
+                retry = isinstance(error, RETRY_ERRORS)
+            else:
+                retry = response.status_code in RETRY_STATUSES
+            if not retry or attempt == retries:
+                break
+            stats.count('retries')
+            time.sleep(self._backoff(policy, attempt, response))
+
+        if error is not None:
+            raise error
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    # returns dictionary host -> latency stats and breaker state
+    def metrics(self):
+        with self._lock:
+            hosts = list(self._stats)
+        return {host: {**self._stats[host].read(), "circuit": self._breakers[host].state} for host in hosts}
+
+
+http_client = HttpClient()
+
+
+"""Tester
+  python http_client.py
+  calls a local stub that fails now and then, then one that is down, and prints the metrics
+"""
+if __name__ == "__main__":
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Flaky(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(random.uniform(0.001, 0.01))
+            status = 503 if random.random() < 0.2 else 200
+            self.send_response(status)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Flaky)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app.config['HTTP_CLIENT_HOSTS'] = {'127.0.0.1': {'backoff': 0.01, 'failure_threshold': 10}, 'localhost': {'reset_seconds': 1}}
+    ok = sum(http_client.get(f'http://127.0.0.1:{server.server_port}/').ok for _ in range(200))
+    print(f"flaky stub: {ok}/200 ok after retries")
+
+    server.shutdown()
+    server.server_close()
+    down = f'http://localhost:{server.server_port}/'
+    outcomes = []
+    for _ in range(10):
+        try:
+            http_client.get(down)
+        except CircuitOpen:
+            outcomes.append('open')
+        except requests.RequestException:
+            outcomes.append('error')
+    print(f"stub down: {outcomes}")
+    for host, metrics in http_client.metrics().items():
+        print(host, metrics)
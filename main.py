@@ -14,10 +14,13 @@ from api.user import user_api # Blueprint import api definition
 from api.event import event_api
 from api.player import player_api
 from api.reviewsapi import reviews_api
+from api.joke import joke_api
+from api.covid import covid_api
 # database migrations
 from model.users import initUsers
 from model.players import initPlayers
 from model.reviews import  initReviews
+from model.jokes import initJokes
 
 # setup App pages
 from projects.projects import app_projects # Blueprint directory import projects definition
@@ -32,6 +35,8 @@ app.register_blueprint(event_api)
 app.register_blueprint(player_api)
 app.register_blueprint(app_projects) # register app pages
 app.register_blueprint(reviews_api)
+app.register_blueprint(joke_api)
+app.register_blueprint(covid_api)
 
 @app.errorhandler(404)  # catch for URL not found
 def page_not_found(e):
@@ -62,6 +67,7 @@ def generate_data():
     initUsers()
     initPlayers()
     initReviews()
+    initJokes()
 
 # Register the custom command group with the Flask application
 app.cli.add_command(custom_cli)
@@ -0,0 +1,261 @@
+""" Card catalog from carddb.json, held in memory and reloaded when the file changes
+
+-- CardCatalog is immutable: the cards and every response body are built once, at load
+-- getCatalog() costs one os.stat per call; when the file's mtime (or size) changed the new catalog
+   is built aside and swapped in with one assignment, so requests see the old or the new one, never a mix
+-- a file that fails to parse keeps the last good catalog in service
+-- NameIndex answers typeahead searches (prefix, substring, one typo) without scanning the names
+"""
+from bisect import bisect_left
+import json
+import os
+import threading
+from types import MappingProxyType
+
+from __init__ import app
+
+
+class CatalogError(Exception):
+    """Raised when there is no card catalog to serve"""
+
+
+NGRAM = 3  # substrings of up to this many characters have postings
+
+
+# True when a and b differ by at most one insert, delete, substitution or swap of neighbours
+def _oneEditApart(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    if len(b) - len(a) > 1:
+        return False
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) < len(b):
+        return a[i:] == b[i + 1:]
+    if a[i + 1:] == b[i + 1:]:
+        return True
+    return i + 1 < len(a) and a[i] == b[i + 1] and a[i + 1] == b[i] and a[i + 2:] == b[i + 2:]
+
+
+# the word with each one of its characters left out
+def _deletes(word):
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+# Typeahead index over names, case folded, built once per catalog
+# -- prefix: names and their other words kept sorted, a prefix is one bisect and a slice
+# -- substring: postings per 1 to NGRAM character gram, in rank order; a query intersects the
+#    postings of its rarest grams, checks the names left and stops at limit
+# -- fuzzy: symmetric delete dictionary of the words in names, finds words one edit away
+#    by looking up the query word and its deletes instead of comparing with every word
+# results come best first: name prefix, word prefix, substring, fuzzy; ties shortest name first
+class NameIndex:
+    def __init__(self, names):
+        folded = [name.casefold() for name in names]
+        self._folded = folded
+        self._order = sorted(range(len(folded)), key=lambda i: (len(folded[i]), folded[i]))
+        self._rank = [0] * len(folded)
+        for position, i in enumerate(self._order):
+            self._rank[i] = position
+
+        self._names = sorted((name, i) for i, name in enumerate(folded))
+        self._name_keys = [name for name, i in self._names]
+        self._words = sorted({(word, i) for i, name in enumerate(folded) for word in name.split()[1:]})
+        self._word_keys = [word for word, i in self._words]
+
+        grams = {}
+        positions = list(range(len(folded)))  # one int object per position, shared by every posting
+        for position, i in enumerate(self._order):
+            name = folded[i]
+            for gram in {name[start:start + n] for n in range(1, NGRAM + 1) for start in range(len(name) - n + 1)}:
+                grams.setdefault(gram, []).append(positions[position])
+        self._grams = {gram: tuple(posting) for gram, posting in grams.items()}
+
+        self._word_cards = {}  # word -> indexes of names containing it
+        for i, name in enumerate(folded):
+            for word in set(name.split()):
+                self._word_cards.setdefault(word, []).append(i)
+        self._variants = {}  # word, or word with one character left out -> words
+        for word in self._word_cards:
+            for variant in _deletes(word) | {word}:
+                self._variants.setdefault(variant, []).append(word)
+
+    def _prefixed(self, entries, keys, text):
+        for position in range(bisect_left(keys, text), len(keys)):
+            if not keys[position].startswith(text):
+                return
+            yield entries[position][1]
+
+    def _containing(self, text):
+        n = min(len(text), NGRAM)
+        postings = [self._grams.get(text[start:start + n]) for start in range(len(text) - n + 1)]
+        if not all(postings):
+            return
+        postings.sort(key=len)
+        if len(text) <= NGRAM:  # the gram is the text, every posting is a match
+            positions = postings[0]
+        else:  # intersect rarest first until few enough names are left to check directly
+            positions = set(postings[0])
+            for posting in postings[1:]:
+                if len(positions) <= 256 or len(posting) > 8 * len(postings[0]):
+                    break
+                positions.intersection_update(posting)
+            positions = sorted(positions)
+        for position in positions:
+            i = self._order[position]
+            if len(text) <= NGRAM or text in self._folded[i]:
+                yield i
+
+    # words of names equal to word or one edit away from it (words of 3+ characters)
+    def _similar(self, word):
+        if len(word) < 3:
+            return {word} if word in self._word_cards else set()
+        return {candidate for variant in _deletes(word) | {word} for candidate in self._variants.get(variant, ())
+                if _oneEditApart(word, candidate)}
+
+    # names having, for every complete word of text, that word or one a typo away from it,
+    # and the last word (possibly still being typed) in the name or a typo away from one of its words
+    def _fuzzy(self, text):
+        *complete, last = text.split()
+        last_similar = self._similar(last)
+        if not complete:
+            matches = {i for word in last_similar for i in self._word_cards[word]}
+        else:
+            sets = sorted(({i for similar in self._similar(word) for i in self._word_cards[similar]}
+                           for word in complete), key=len)
+            matches = sets[0].intersection(*sets[1:])
+            matches = {i for i in matches
+                       if last in self._folded[i] or not last_similar.isdisjoint(self._folded[i].split())}
+        return sorted(matches, key=self._rank.__getitem__)
+
+    # returns list of indexes of names matching text, at most limit
+    def search(self, text, limit):
+        text = ' '.join(text.casefold().split())
+        found = []
+        if not text:
+            return found
+        seen = set()
+        for matches in (self._prefixed(self._names, self._name_keys, text),
+                        self._prefixed(self._words, self._word_keys, text),
+                        self._containing(text)):
+            for i in matches:
+                if i not in seen:
+                    seen.add(i)
+                    found.append(i)
+                    if len(found) >= limit:
+                        return found
+        for i in self._fuzzy(text):  # only computed when the exact matches did not fill the limit
+            if i not in seen:
+                found.append(i)
+                if len(found) >= limit:
+                    break
+        return found
+
+
+class CardCatalog:
+    # data is the parsed carddb.json, stamp identifies the file version it was read from
+    def __init__(self, data, stamp):
+        cards = []
+        for item in data.get('items', []):
+            card = {
+                "name": item.get("name", ""),
+                "maxLevel": item.get("maxLevel", 0),
+            }
+            medium_icon_url = item.get("iconUrls", {}).get("medium", "")
+            if medium_icon_url:
+                card["medium"] = medium_icon_url
+            cards.append(card)
+
+        dumps = app.json.dumps  # same encoding as jsonify
+        self.cards = tuple(MappingProxyType(card) for card in cards)
+        self.stamp = stamp
+        self.etag = f'{stamp[0]:x}-{stamp[1]:x}'
+        self.card_bodies = tuple(dumps(card).encode() for card in cards)
+        self.read_body = b'[[' + b','.join(self.card_bodies) + b']]\n'  # list wrapped in a list, as /api/reviews/ always answered
+        self.count_body = dumps({"count": len(cards)}).encode() + b'\n'
+        self.index = NameIndex([card["name"] for card in cards])
+
+    def __len__(self):
+        return len(self.cards)
+
+    # typeahead: cards whose name starts with, contains, or is one typo away from text, best first
+    # returns json array body
+    def search(self, text, limit):
+        return b'[' + b','.join(self.card_bodies[i] for i in self.index.search(text, limit)) + b']\n'
+
+
+_catalog = None
+_failed = None  # stamp of a file version that did not parse, not retried until the file changes again
+_lock = threading.Lock()
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+# Current catalog, reloaded when carddb.json changed since it was read
+# returns CardCatalog, raises CatalogError when the file cannot be read and nothing was loaded before
+def getCatalog():
+    global _catalog, _failed
+    path = app.config['CARD_DB_PATH']
+    catalog = _catalog
+    try:
+        stamp = _stamp(path)
+    except FileNotFoundError:
+        if catalog is None:
+            raise CatalogError("File not found")
+        return catalog
+    if catalog is not None and stamp in (catalog.stamp, _failed):
+        return catalog
+    with _lock:  # one thread parses, the others wait and use its result
+        if _catalog is not None and _catalog.stamp == stamp:
+            return _catalog
+        try:
+            with open(path, 'r') as json_file:
+                catalog = CardCatalog(json.load(json_file), stamp)
+        except (OSError, json.JSONDecodeError, AttributeError) as e:
+            if _catalog is None:
+                raise CatalogError("Invalid JSON format in the file" if not isinstance(e, OSError) else "File not found")
+            app.logger.warning(f'{path} not reloaded, keeping the previous catalog: {e}')
+            _failed = stamp
+            return _catalog
+        _catalog = catalog
+        return catalog
+
+
+"""Benchmark
+  python -m model.cards [cards]
+  typeahead time per keystroke on carddb.json grown to the given number of made up cards
+"""
+if __name__ == "__main__":
+    import random
+    import sys
+    import time
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with open(app.config['CARD_DB_PATH']) as json_file:
+        names = [item['name'] for item in json.load(json_file)['items']]
+    syllables = ['ar', 'ch', 'er', 'kn', 'ight', 'gob', 'lin', 'drag', 'on', 'wiz', 'ard', 'mag', 'ic', 'gi', 'ant']
+    random.seed(1)
+    while len(names) < size:
+        names.append(' '.join(''.join(random.choices(syllables, k=random.randint(2, 4))).title()
+                              for _ in range(random.randint(1, 3))))
+    start = time.perf_counter()
+    index = NameIndex(names)
+    print(f"{len(names)} names indexed in {time.perf_counter() - start:.2f} s")
+
+    queries = ['archer queen', 'magic archer', 'goblin giant', 'knigth', 'wizzard', 'ightgob', 'dr', 'x']
+    keystrokes = [query[:n] for query in queries for n in range(1, len(query) + 1)]
+    times = []
+    for text in keystrokes:
+        start = time.perf_counter()
+        index.search(text, 10)
+        times.append(time.perf_counter() - start)
+    print(f"{len(keystrokes)} keystrokes (limit 10): {sum(times) / len(times) * 1e3:.3f} ms average, "
+          f"{max(times) * 1e3:.3f} ms slowest")
+    for text in ('knigth', 'wizzard', 'archr queen'):
+        start = time.perf_counter()
+        found = index.search(text, 10)
+        print(f"{text!r}: {[names[i] for i in found[:3]]} {(time.perf_counter() - start) * 1e3:.3f} ms")
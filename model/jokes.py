@@ -1,6 +1,21 @@
+""" Jokes with haha/boohoo vote counts shared by every worker
+
+Votes are counted in memory and written behind (see VoteCounter): a vote is a dictionary increment
+under a lock, a background thread adds the pending counts to the joke_votes table every
+JOKE_FLUSH_INTERVAL seconds in one transaction (haha = haha + n, so workers never overwrite each other)
+and reads back the rows other workers changed since its last look.
+Most liked / most jeered are read from RankedCounts kept current with every change, O(k) per read.
+"""
+from bisect import bisect_left, insort
 import random
+import sys
+import time
+
+from __init__ import app, db
+from model.versions import touch
+from process_local import WriteBehind
+from sqlalchemy import text
 
-jokes_data = []
 joke_list = [
     "If you give someone a program... you will frustrate them for a day; if you teach them how to program... you will "
     "frustrate them for a lifetime.",
@@ -24,63 +39,216 @@ joke_list = [
     'An SQL statement walks into a bar and sees two tables. It approaches, and asks may I join you?'
 ]
 
-# Initialize jokes
+
+# jokes and their ids, the votes are kept by vote_counter
+jokes_data = [{"id": item_id, "joke": item} for item_id, item in enumerate(joke_list)]
+
+HAHA, BOOHOO = 0, 1  # vote kinds, index in the counts pairs
+
+
+# Define the JokeVotes class to manage the 'joke_votes' table, one row per joke with votes
+# version is the jokes table version (touch) of the flush that last changed the row
+class JokeVotes(db.Model):
+    __tablename__ = 'joke_votes'
+
+    jokeID = db.Column(db.Integer, primary_key=True)
+    haha = db.Column(db.Integer, nullable=False, default=0)
+    boohoo = db.Column(db.Integer, nullable=False, default=0)
+    version = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+
+# Counts kept in descending order as they change, for top-k reads without a scan
+# -- a list of (-count, id) kept sorted with bisect: a change is two bisects (and a memmove), top-k is a slice
+# -- ids with a count of 0 are left out
+# not thread safe, VoteCounter calls it under its lock
+class RankedCounts:
+    def __init__(self):
+        self._keys = []
+        self._counts = {}  # id -> count
+
+    def set(self, id, count):
+        old = self._counts.get(id, 0)
+        if old == count:
+            return
+        if old:
+            del self._keys[bisect_left(self._keys, (-old, id))]
+        if count:
+            insort(self._keys, (-count, id))
+            self._counts[id] = count
+        else:
+            del self._counts[id]
+
+    # returns list of (id, count), highest count first, ties by lowest id
+    def top(self, k):
+        return [(id, -negative) for negative, id in self._keys[:k]]
+
+
+# Vote counts of this worker: persisted (as last read from joke_votes) + flushing + pending
+# -- vote() only touches memory, thousands per second per worker (a WriteBehind of joke id -> [haha, boohoo])
+# -- each flush writes pending counts with one upsert per joke, then reads rows changed by any
+#    worker since the last read (version > seen), so every worker converges within an interval
+class VoteCounter(WriteBehind):
+    def __init__(self, interval=None):
+        super().__init__('joke-votes', 'JOKE_FLUSH_INTERVAL', interval)
+        self._persisted = {}  # joke id -> [haha, boohoo] as stored
+        self._seen = None  # highest version read, None until the first read
+        self._ranked = (RankedCounts(), RankedCounts())  # totals by kind, HAHA and BOOHOO
+
+    # the rankings copied through fork counted the parent's pending votes
+    def forked(self):
+        self._ranked = (RankedCounts(), RankedCounts())
+        for id in self._persisted:
+            self._rank(id)
+
+    # adds one vote of kind HAHA or BOOHOO
+    # returns the joke's counts [haha, boohoo] as this worker sees them
+    def vote(self, id, kind):
+        with self._lock:
+            self._add(id, (1, 0) if kind == HAHA else (0, 1))
+            return self._rank(id)
+
+    # caller holds the lock, moves the joke to its place in the rankings
+    # returns its counts
+    def _rank(self, id):
+        counts = self._counts(id)
+        self._ranked[HAHA].set(id, counts[HAHA])
+        self._ranked[BOOHOO].set(id, counts[BOOHOO])
+        return counts
+
+    # caller holds the lock
+    def _counts(self, id):
+        counts = [0, 0]
+        for source in (self._persisted, self._flushing, self._pending):
+            delta = source.get(id)
+            if delta:
+                counts[HAHA] += delta[HAHA]
+                counts[BOOHOO] += delta[BOOHOO]
+        return counts
+
+    def _load(self):
+        with self._lock:
+            self._begin()
+        if self._seen is None:
+            self.refresh()  # first read in this worker
+
+    # returns [haha, boohoo] of one joke
+    def counts(self, id):
+        self._load()
+        with self._lock:
+            return self._counts(id)
+
+    # the k jokes with the most votes of kind HAHA or BOOHOO, jokes without such votes are left out
+    # returns list of (id, [haha, boohoo])
+    def top(self, kind, k):
+        self._load()
+        with self._lock:
+            return [(id, self._counts(id)) for id, count in self._ranked[kind].top(k)]
+
+    # writes pending votes in one transaction
+    def write(self, batch):
+        with app.app_context():
+            try:
+                version = touch('jokes')['jokes']
+                db.session.execute(text(
+                    "INSERT INTO joke_votes (jokeID, haha, boohoo, version) VALUES (:id, :haha, :boohoo, :version) "
+                    "ON CONFLICT (jokeID) DO UPDATE SET haha = haha + excluded.haha, "
+                    "boohoo = boohoo + excluded.boohoo, version = excluded.version"),
+                    [{"id": id, "haha": counts[HAHA], "boohoo": counts[BOOHOO], "version": version}
+                     for id, counts in batch.items()])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        return len(batch)
+
+    # after each flush reads what changed, the written votes move from flushing to persisted in one step
+    def written(self):
+        with app.app_context():
+            self._refresh(clear_flushing=True)
+
+    # reads rows changed since the last read, by this worker or any other
+    def refresh(self):
+        with app.app_context():
+            self._refresh()
+
+    def _refresh(self, clear_flushing=False):
+        rows = db.session.execute(db.select(JokeVotes.jokeID, JokeVotes.haha, JokeVotes.boohoo, JokeVotes.version)
+                                  .where(JokeVotes.version > (self._seen or 0))).all()
+        db.session.commit()  # end the read transaction
+        with self._lock:
+            for id, haha, boohoo, version in rows:
+                self._persisted[id] = [haha, boohoo]
+                self._seen = max(self._seen or 0, version)
+            if clear_flushing:
+                self._flushing = {}
+            for id, haha, boohoo, version in rows:  # votes from other workers move the rankings
+                self._rank(id)
+            if self._seen is None:
+                self._seen = 0
+
+
+vote_counter = VoteCounter()
+
+
+# Initialize jokes, creates the votes table and primes some votes the first time
 def initJokes():
-    # setup jokes into a dictionary with id, joke, haha, boohoo
-    item_id = 0
-    for item in joke_list:
-        jokes_data.append({"id": item_id, "joke": item, "haha": 0, "boohoo": 0})
-        item_id += 1
+    with app.app_context():
+        db.create_all()
+        if JokeVotes.query.first() is not None:
+            return
     # prime some haha responses
     for i in range(10):
         id = getRandomJoke()['id']
         addJokeHaHa(id)
-    # prime some haha responses
+    # prime some boohoo responses
     for i in range(5):
         id = getRandomJoke()['id']
         addJokeBooHoo(id)
-        
+    vote_counter.flush()
+
+
+# joke with its current counts
+def _withVotes(joke):
+    haha, boohoo = vote_counter.counts(joke['id'])
+    return {**joke, "haha": haha, "boohoo": boohoo}
+
 # Return all jokes from jokes_data
 def getJokes():
-    return(jokes_data)
+    return [_withVotes(joke) for joke in jokes_data]
 
 # Joke getter
 def getJoke(id):
-    return(jokes_data[id])
+    return _withVotes(jokes_data[id])
 
 # Return random joke from jokes_data
 def getRandomJoke():
-    return(random.choice(jokes_data))
+    return _withVotes(random.choice(jokes_data))
+
+# Most liked jokes, highest haha first
+def likedJokes(k):
+    return [{**jokes_data[id], "haha": haha, "boohoo": boohoo} for id, (haha, boohoo) in vote_counter.top(HAHA, k)]
 
-# Liked joke
+# Most jeered jokes, highest boohoo first
+def jeeredJokes(k):
+    return [{**jokes_data[id], "haha": haha, "boohoo": boohoo} for id, (haha, boohoo) in vote_counter.top(BOOHOO, k)]
+
+# Liked joke, None when no joke has a haha yet
 def favoriteJoke():
-    best = 0
-    bestID = -1
-    for joke in getJokes():
-        if joke['haha'] > best:
-            best = joke['haha']
-            bestID = joke['id']
-    return jokes_data[bestID]
+    best = likedJokes(1)
+    return best[0] if best else None
     
-# Jeered joke
+# Jeered joke, None when no joke has a boohoo yet
 def jeeredJoke():
-    worst = 0
-    worstID = -1
-    for joke in getJokes():
-        if joke['boohoo'] > worst:
-            worst = joke['boohoo']
-            worstID = joke['id']
-    return jokes_data[worstID]
+    worst = jeeredJokes(1)
+    return worst[0] if worst else None
 
 # Add to haha for requested id
 def addJokeHaHa(id):
-    jokes_data[id]['haha'] = jokes_data[id]['haha'] + 1
-    return jokes_data[id]['haha']
+    return vote_counter.vote(id, HAHA)[HAHA]
 
 # Add to boohoo for requested id
 def addJokeBooHoo(id):
-    jokes_data[id]['boohoo'] = jokes_data[id]['boohoo'] + 1
-    return jokes_data[id]['boohoo']
+    return vote_counter.vote(id, BOOHOO)[BOOHOO]
 
 # Pretty Print joke
 def printJoke(joke):
@@ -90,21 +258,49 @@ def printJoke(joke):
 def countJokes():
     return len(jokes_data)
 
+"""Benchmark
+  python -m model.jokes bench
+  100k jokes: a vote moving a joke in RankedCounts and a top-10 read, next to the scan they replace
+"""
+if __name__ == "__main__" and sys.argv[1:] == ['bench']:
+    size, votes = 100000, 200000
+    random.seed(1)
+    counts = [0] * size
+    ranked = RankedCounts()
+    ids = [random.randrange(size) for _ in range(votes)]
+    start = time.perf_counter()
+    for id in ids:
+        counts[id] += 1
+        ranked.set(id, counts[id])
+    print(f"vote + rank update: {(time.perf_counter() - start) / votes * 1e6:8.2f} us")
+    start = time.perf_counter()
+    for _ in range(1000):
+        top = ranked.top(10)
+    print(f"top 10 read:        {(time.perf_counter() - start) / 1000 * 1e6:8.2f} us")
+    start = time.perf_counter()
+    for _ in range(10):
+        scan = sorted(range(size), key=lambda id: (-counts[id], id))[:10]
+    print(f"top 10 by scan:     {(time.perf_counter() - start) / 10 * 1e6:8.2f} us")
+    assert [id for id, count in top] == scan
+
 # Test Joke Model
-if __name__ == "__main__": 
+elif __name__ == "__main__": 
+    db.init_app(app)  # done by main.py when serving
     initJokes()  # initialize jokes
     
     # Most likes and most jeered
     best = favoriteJoke()
-    print("Most liked", best['haha'])
-    printJoke(best)
+    if best:
+        print("Most liked", best['haha'])
+        printJoke(best)
     worst = jeeredJoke()
-    print("Most jeered", worst['boohoo'])
-    printJoke(worst)
+    if worst:
+        print("Most jeered", worst['boohoo'])
+        printJoke(worst)
     
     # Random joke
     print("Random joke")
     printJoke(getRandomJoke())
     
     # Count of Jokes
-    print("Jokes Count: " + str(countJokes()))
\ No newline at end of file
+    print("Jokes Count: " + str(countJokes()))
@@ -0,0 +1,215 @@
+""" Token balance changes for players, recorded in the append-only token_ledger
+
+Every change is one atomic UPDATE players SET _tokens = _tokens + delta (no read-modify-write in Python,
+so concurrent changes are never lost) plus a ledger row, in the same transaction.
+-- increment(): one change, committed before it returns
+-- transfer(): debit and credit in one transaction, refused when the payer has too few tokens
+-- token_buffer.credit(): high frequency game events, summed in memory per (player, reason) and
+   written by a background thread every TOKEN_FLUSH_INTERVAL seconds, one transaction per flush;
+   credits not yet flushed are lost if the worker is killed (they are flushed on a normal exit)
+-- takeSnapshot(): every TOKEN_SNAPSHOT_INTERVAL seconds a thread of each worker that wrote to the ledger
+   records the balance of players with new ledger rows, checkBalance() compares snapshot + later rows
+   with players._tokens
+"""
+from datetime import datetime
+import threading
+import time
+
+from sqlalchemy import text
+
+from __init__ import app, db
+from model.players import Player, TokenEntry, TokenSnapshot, leaderboard
+from model.versions import touch
+from process_local import ProcessLocal, WriteBehind
+
+
+class NotEnoughTokens(ValueError):
+    """Raised when a debit would take a balance below zero"""
+
+
+# adds delta to one balance inside the current transaction, refused below zero when floor is set
+# returns the new balance or None when no player was changed
+def _addTokens(player_id, delta, floor=False):
+    statement = db.update(Player).where(Player.id == player_id) \
+        .values(_tokens=db.func.coalesce(Player._tokens, 0) + delta).returning(Player._tokens) \
+        .execution_options(synchronize_session=False)
+    if floor:
+        statement = statement.where(db.func.coalesce(Player._tokens, 0) + delta >= 0)
+    return db.session.execute(statement).scalar()
+
+
+# commits the transaction and tells the leaderboard, balances is dictionary of player id -> tokens
+def _commit(balances):
+    version = touch('players')['players']
+    db.session.commit()
+    leaderboard.adjust(version, balances)
+    snapshots.get()
+
+
+# Adds delta (may be negative) to a player's tokens
+# returns the new balance, raises NotEnoughTokens or LookupError for an unknown player
+def increment(player_id, delta, reason=None):
+    tokens = _addTokens(player_id, delta, floor=delta < 0)
+    if tokens is None:
+        db.session.rollback()
+        if db.session.get(Player, player_id) is None:
+            raise LookupError(f'Player {player_id} not found')
+        raise NotEnoughTokens(f'Player {player_id} has fewer than {-delta} tokens')
+    db.session.add(TokenEntry(playerID=player_id, delta=delta, reason=reason))
+    _commit({player_id: tokens})
+    return tokens
+
+
+# Moves amount tokens between players in one transaction
+# returns (payer balance, payee balance), raises NotEnoughTokens or LookupError
+def transfer(payer_id, payee_id, amount, reason=None):
+    if db.session.get(Player, payee_id) is None:
+        raise LookupError(f'Player {payee_id} not found')
+    payer = _addTokens(payer_id, -amount, floor=True)
+    if payer is None:
+        db.session.rollback()
+        if db.session.get(Player, payer_id) is None:
+            raise LookupError(f'Player {payer_id} not found')
+        raise NotEnoughTokens(f'Player {payer_id} has fewer than {amount} tokens')
+    payee = _addTokens(payee_id, amount)
+    if payee is None:  # deleted since the check above
+        db.session.rollback()
+        raise LookupError(f'Player {payee_id} not found')
+    db.session.add_all([TokenEntry(playerID=payer_id, delta=-amount, reason=reason),
+                        TokenEntry(playerID=payee_id, delta=amount, reason=reason)])
+    _commit({payer_id: payer, payee_id: payee})
+    return payer, payee
+
+
+# Applies coalesced credits in one transaction, credits is dictionary of (player id, reason) -> [delta, count]
+# one UPDATE per player and one multi-row INSERT for the ledger, credits of deleted players are dropped
+# returns number of ledger rows written
+def applyCredits(credits):
+    totals = {}
+    for (player_id, reason), (delta, count) in credits.items():
+        totals[player_id] = totals.get(player_id, 0) + delta
+    balances = {}
+    for player_id, delta in totals.items():
+        tokens = _addTokens(player_id, delta)
+        if tokens is not None:
+            balances[player_id] = tokens
+    now = datetime.utcnow()
+    entries = [{"playerID": player_id, "delta": delta, "count": count, "reason": reason, "created": now}
+               for (player_id, reason), (delta, count) in credits.items() if player_id in balances]
+    if entries:
+        db.session.execute(db.insert(TokenEntry), entries)
+    _commit(balances)
+    return len(entries)
+
+
+# Coalescing write-behind buffer for credits, one per worker process
+# a WriteBehind of (player id, reason) -> [delta, count], written by applyCredits
+class TokenBuffer(WriteBehind):
+    def __init__(self, interval=None, max_pending=10000):
+        super().__init__('token-buffer', 'TOKEN_FLUSH_INTERVAL', interval, max_pending)
+
+    # adds a credit of delta > 0 tokens to the buffer, written within interval seconds
+    def credit(self, player_id, delta, reason=None):
+        self.add((player_id, reason), (delta, 1))
+
+    # returns number of ledger rows written
+    def write(self, batch):
+        with app.app_context():
+            try:
+                return applyCredits(batch)
+            except Exception:
+                db.session.rollback()
+                raise
+
+
+token_buffer = TokenBuffer()
+
+
+# Records the balance of every player with ledger rows after the last snapshot
+# one statement, so the balances and the ledger id they are as of are consistent
+# returns number of snapshots taken
+def takeSnapshot():
+    result = db.session.execute(text(
+        "INSERT INTO token_snapshots (playerID, ledgerID, balance, taken) "
+        "SELECT p.id, (SELECT MAX(id) FROM token_ledger), COALESCE(p._tokens, 0), :now FROM players p "
+        "WHERE p.id IN (SELECT playerID FROM token_ledger "
+        "WHERE id > (SELECT COALESCE(MAX(ledgerID), 0) FROM token_snapshots))"), {"now": datetime.utcnow()})
+    db.session.commit()
+    return result.rowcount
+
+
+def _takeSnapshots():
+    while True:
+        time.sleep(app.config['TOKEN_SNAPSHOT_INTERVAL'])
+        try:
+            with app.app_context():
+                takeSnapshot()
+        except Exception:
+            app.logger.exception('token snapshot failed, retrying')
+
+
+def _startSnapshots():
+    thread = threading.Thread(target=_takeSnapshots, name='token-snapshots', daemon=True)
+    thread.start()
+    return thread
+
+
+# snapshot thread of this process, started by its first ledger write (_commit, Player.create/update)
+snapshots = ProcessLocal(_startSnapshots)
+
+
+# Balance from the ledger (last snapshot + the rows after it) next to the stored balance
+# returns dictionary tokens, ledger, consistent, snapshot (ledger id and time or None)
+def checkBalance(player):
+    snapshot = db.session.execute(db.select(TokenSnapshot).where(TokenSnapshot.playerID == player.id)
+                                  .order_by(TokenSnapshot.ledgerID.desc()).limit(1)).scalar()
+    since = snapshot.ledgerID if snapshot else 0
+    total = db.session.scalar(db.select(db.func.coalesce(db.func.sum(TokenEntry.delta), 0))
+                              .where(TokenEntry.playerID == player.id, TokenEntry.id > since))
+    ledger = (snapshot.balance if snapshot else 0) + total
+    return {
+        "tokens": player.tokens or 0,
+        "ledger": ledger,
+        "consistent": ledger == (player.tokens or 0),
+        "snapshot": {"ledgerID": snapshot.ledgerID, "taken": snapshot.taken.isoformat()} if snapshot else None,
+    }
+
+
+"""Benchmark
+  python -m model.ledger [credits]
+  credits per second through increment() (one commit each) and through token_buffer (coalesced)
+"""
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    credits = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as directory:
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{directory}/ledger.db'
+        app.config['RESPONSE_CACHE_PATH'] = f'{directory}/cache.db'
+        db.init_app(app)  # done by main.py when serving
+        with app.app_context():
+            db.create_all()
+            players = [Player(name=f'Player {i}', uid=f'p{i}', tokens=0) for i in range(50)]
+            db.session.add_all(players)
+            db.session.commit()
+            ids = [player.id for player in players]
+
+            start = time.perf_counter()
+            for i in range(credits // 10):
+                increment(ids[i % len(ids)], 1, 'bench')
+            print(f"increment:    {credits // 10 / (time.perf_counter() - start):10.0f} credits/sec")
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=lambda n: [token_buffer.credit(ids[i % len(ids)], 1, 'bench') for i in range(n)],
+                                    args=(credits // 4,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        token_buffer.flush()
+        print(f"token_buffer: {credits / (time.perf_counter() - start):10.0f} credits/sec")
+
+        with app.app_context():
+            takeSnapshot()
+            print(all(checkBalance(player)['consistent'] for player in Player.query.all()), 'ledger consistent')
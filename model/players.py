@@ -1,10 +1,14 @@
 """ database dependencies to support sqliteDB examples """
 from random import randrange
-from datetime import date
+from datetime import date, datetime
+from bisect import bisect_left, insort
 import os, base64
 import json
+import threading
 
 from __init__ import app, db
+from model.versions import touch, getVersions
+from sqlalchemy import text
 from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -13,6 +17,11 @@ from werkzeug.security import generate_password_hash, check_password_hash
 
 class Player(db.Model):
     __tablename__ = 'players'  # table name is plural, class name is singular
+    # the order of the leaderboard, read without a sort: SQLite scans the index backwards for tokens descending
+    # plain columns, an expression index (desc) is skipped by migrate on SQLite
+    __table_args__ = (
+        db.Index('ix_players_tokens', '_tokens', 'id'),
+    )
 
     # Define the Player schema with "vars" from object
     id = db.Column(db.Integer, primary_key=True)
@@ -21,6 +30,15 @@ class Player(db.Model):
     _password = db.Column(db.String(255), unique=False, nullable=False)
     _tokens = db.Column(db.Integer)    
 
+    # read() keys -> columns each one needs, used to SELECT only what ?fields= asks for
+    READ_FIELDS = {
+        "id": ("id",),
+        "name": ("_name",),
+        "uid": ("_uid",),
+        "tokens": ("_tokens",),
+        "password": ("_password",),
+    }
+
     # constructor of a Player object, initializes the instance variables within object (self)
     def __init__(self, name, uid, tokens, password="123qwerty"):
         self._name = name    # variables with self prefix become part of the object, 
@@ -89,7 +107,14 @@ class Player(db.Model):
         try:
             # creates a player object from Player(db.Model) class, passes initializers
             db.session.add(self)  # add prepares to persist person object to Users table
+            if self._tokens:
+                db.session.flush()  # assigns self.id
+                db.session.add(TokenEntry(playerID=self.id, delta=self._tokens, reason='opening'))
+            version = touch('players')['players']  # new version for conditional GETs
             db.session.commit()  # SqlAlchemy "unit of work pattern" requires a manual commit
+            leaderboard.apply(version, self.id, self._uid, self._name, self._tokens)
+            if self._tokens:
+                startSnapshots()
             return self
         except IntegrityError:
             db.session.remove()
@@ -97,14 +122,13 @@ class Player(db.Model):
 
     # CRUD read converts self to dictionary
     # returns dictionary
-    def read(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "uid": self.uid,
-            "tokens": self.tokens,
-            "password": self._password
-        }
+    # fields limits the keys to the ones asked for, no other attribute is touched
+    def read(self, fields=None):
+        fields = fields or Player.READ_FIELDS
+        data = {field: getattr(self, field) for field in fields if field != "password"}
+        if "password" in fields:
+            data["password"] = self._password
+        return data
 
     # CRUD update: updates name, uid, password, tokens
     # returns self
@@ -118,8 +142,17 @@ class Player(db.Model):
             if key == "password":
                 self.set_password(dictionary[key])
             if key == "tokens":
+                # ledger entry for the difference to the stored balance, read and written in one statement
+                db.session.execute(text(
+                    "INSERT INTO token_ledger (playerID, delta, count, reason, created) "
+                    "SELECT id, :tokens - COALESCE(_tokens, 0), 1, 'set', :now FROM players WHERE id = :id"),
+                    {"tokens": dictionary[key] or 0, "now": datetime.utcnow(), "id": self.id})
                 self.tokens = dictionary[key]
+        version = touch('players')['players']
         db.session.commit()
+        leaderboard.apply(version, self.id, self._uid, self._name, self._tokens)
+        if "tokens" in dictionary:
+            startSnapshots()
         return self
 
     # CRUD delete: remove self
@@ -127,18 +160,179 @@ class Player(db.Model):
     def delete(self):
         player = self
         db.session.delete(self)
+        version = touch('players')['players']
         db.session.commit()
+        leaderboard.apply(version, player.id)
         return player
 
 
+# Define the TokenEntry class to manage the append-only 'token_ledger' table, one row per balance change
+# -- rows are never updated or deleted, players._tokens is the running total kept in the same transaction
+# -- count is how many game events were coalesced into the row (see model/ledger.py)
+class TokenEntry(db.Model):
+    __tablename__ = 'token_ledger'
+    __table_args__ = (
+        db.Index('ix_token_ledger_player', 'playerID', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    playerID = db.Column(db.Integer, db.ForeignKey('players.id'), nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=1)
+    reason = db.Column(db.String(64))
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def read(self):
+        return {
+            "id": self.id,
+            "playerID": self.playerID,
+            "delta": self.delta,
+            "count": self.count,
+            "reason": self.reason,
+            "created": self.created.isoformat(),
+        }
+
+
+# Define the TokenSnapshot class to manage the 'token_snapshots' table
+# the balance of a player as of ledger entry ledgerID, so a balance check only sums the entries after it
+class TokenSnapshot(db.Model):
+    __tablename__ = 'token_snapshots'
+    __table_args__ = (
+        db.Index('ix_token_snapshots_player', 'playerID', 'ledgerID'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    playerID = db.Column(db.Integer, db.ForeignKey('players.id'), nullable=False)
+    ledgerID = db.Column(db.Integer, nullable=False)
+    balance = db.Column(db.Integer, nullable=False)
+    taken = db.Column(db.DateTime, nullable=False)
+
+
+# Players ranked by tokens, kept in memory so top-N and rank lookups never scan the table
+# -- a list of (-tokens, id) kept sorted with bisect, top-N is a slice, a rank is one bisect
+# -- Player.create/update/delete apply their change after commit
+# -- writes by other workers are seen through the players table version (touch):
+#    when it moved on without us the list is reloaded once, at the next read
+class Leaderboard:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []  # (-tokens, id), ascending is tokens descending
+        self._players = {}  # id -> (key, uid, name)
+        self._ids = {}  # uid -> id
+        self._version = None  # players version the list reflects, None until loaded
+
+    # loads every player, ix_players_tokens read backwards with no sort step in SQL,
+    # equal tokens come in descending id order and the sort below turns those short runs around
+    def _load(self, version):
+        rows = db.session.execute(db.select(Player.id, Player._uid, Player._name, Player._tokens)
+                                  .order_by(Player._tokens.desc(), Player.id.desc())).all()
+        self._players = {id: ((-(tokens or 0), id), uid, name) for id, uid, name, tokens in rows}
+        self._keys = sorted(player[0] for player in self._players.values())
+        self._ids = {uid: id for id, (key, uid, name) in self._players.items()}
+        self._version = version
+
+    # caller holds the lock
+    def _refresh(self):
+        version = getVersions('players')[0]
+        if version != self._version:
+            self._load(version)
+
+    def _remove(self, id):
+        player = self._players.pop(id, None)
+        if player is not None:
+            key, uid, name = player
+            del self._keys[bisect_left(self._keys, key)]
+            self._ids.pop(uid, None)
+
+    def _insert(self, id, uid, name, tokens):
+        key = (-(tokens or 0), id)
+        insort(self._keys, key)
+        self._players[id] = (key, uid, name)
+        self._ids[uid] = id
+
+    # caller holds the lock, True when version follows the one the list reflects
+    def _follows(self, version):
+        if self._version is None or self._version != version - 1:
+            self._version = None  # not loaded, or another worker wrote in between: reload at next read
+            return False
+        self._version = version
+        return True
+
+    # records a committed write, version is what touch('players') returned for it
+    # tokens None with no uid means the player was deleted
+    def apply(self, version, id, uid=None, name=None, tokens=None):
+        with self._lock:
+            if self._follows(version):
+                self._remove(id)
+                if uid is not None:
+                    self._insert(id, uid, name, tokens)
+
+    # records committed token balances, balances is dictionary of player id -> tokens
+    def adjust(self, version, balances):
+        with self._lock:
+            if self._follows(version):
+                for id, tokens in balances.items():
+                    if id in self._players:
+                        key, uid, name = self._players[id]
+                        self._remove(id)
+                        self._insert(id, uid, name, tokens)
+
+    # players with the most tokens, equal tokens share a rank
+    # returns list of dictionaries rank, uid, name, tokens
+    def top(self, n):
+        with self._lock:
+            self._refresh()
+            result = []
+            for index, key in enumerate(self._keys[:n]):
+                rank = result[-1]['rank'] if result and result[-1]['tokens'] == -key[0] else index + 1
+                _, uid, name = self._players[key[1]]
+                result.append({'rank': rank, 'uid': uid, 'name': name, 'tokens': -key[0]})
+            return result
+
+    # rank of one player, 1 + players with more tokens
+    # returns dictionary rank, uid, name, tokens, players or None for an unknown uid
+    def rank(self, uid):
+        with self._lock:
+            self._refresh()
+            id = self._ids.get(uid)
+            if id is None:
+                return None
+            key, uid, name = self._players[id]
+            rank = bisect_left(self._keys, (key[0],)) + 1  # (-tokens,) sorts before every (-tokens, id)
+            return {'rank': rank, 'uid': uid, 'name': name, 'tokens': -key[0], 'players': len(self._keys)}
+
+
+leaderboard = Leaderboard()
+
+
+# starts the periodic token snapshots of this process after a ledger write (see model/ledger.py)
+def startSnapshots():
+    from model.ledger import snapshots  # model.ledger imports this module
+    snapshots.get()
+
+
 """Database Creation and Testing """
 
 
+# Opening ledger entries for players stored before the ledger existed (or with no rows in it),
+# so the ledger of every player adds up to players._tokens
+# returns number of entries written
+def openLedgers():
+    result = db.session.execute(text(
+        "INSERT INTO token_ledger (playerID, delta, count, reason, created) "
+        "SELECT id, _tokens, 1, 'opening', :now FROM players "
+        "WHERE COALESCE(_tokens, 0) != 0 AND id NOT IN (SELECT playerID FROM token_ledger)"),
+        {"now": datetime.utcnow()})
+    db.session.commit()
+    return result.rowcount
+
+
 # Builds working data for testing
 def initPlayers():
     with app.app_context():
         """Create database and tables"""
         db.create_all()
+        openLedgers()  # players of databases created before the ledger
         """Tester records for table"""
         players = [
             Player(name='Azeem Khan', uid='azeemK', tokens=45),
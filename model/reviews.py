@@ -1,36 +1,107 @@
-from flask_sqlalchemy import SQLAlchemy
-from datetime import date
-import os
+""" database dependencies to support sqliteDB examples """
+from __init__ import app, db
+from model.versions import touch
+from sqlalchemy import text
+
+RATINGS = range(1, 6)  # stars a review can give
 
-# Initialize the SQLAlchemy object
-db = SQLAlchemy()
 
 # Define the Review class to manage actions in the 'reviews' table
 class Review(db.Model):
     __tablename__ = 'reviews'
+    # reviews of one title in id order, the pages of GET /api/reviews/titles/<title>
+    __table_args__ = (
+        db.Index('ix_reviews_title_id', 'title', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.Text, nullable=False)
     review = db.Column(db.Text, nullable=False)
+    rating = db.Column(db.Integer, nullable=False)
 
-    def __init__(self, title, review):
+    def __init__(self, title, review, rating):
         self.title = title
         self.review = review
+        self.rating = rating
 
     def __repr__(self):
-        return f"Review(id={self.id}, title={self.title}, review={self.review})"
+        return f"Review(id={self.id}, title={self.title}, review={self.review}, rating={self.rating})"
+
+    # CRUD create, the title's review_stats row is updated in the same transaction
+    # returns self
+    def create(self):
+        db.session.add(self)
+        addToStats(self.title, self.rating)
+        touch('reviews')
+        db.session.commit()
+        return self
+
+    # CRUD read converts self to dictionary
+    # returns dictionary
+    def read(self):
+        return {
+            "id": self.id,
+            "title": self.title,
+            "review": self.review,
+            "rating": self.rating,
+        }
+
+
+# Define the ReviewStats class to manage the 'review_stats' table, one row per title
+# a materialized aggregate of reviews: count, sum of ratings and a count per rating,
+# updated with each insert so a summary never reads the reviews themselves
+class ReviewStats(db.Model):
+    __tablename__ = 'review_stats'
+
+    title = db.Column(db.Text, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)  # sum of ratings
+    stars_1 = db.Column(db.Integer, nullable=False, default=0)
+    stars_2 = db.Column(db.Integer, nullable=False, default=0)
+    stars_3 = db.Column(db.Integer, nullable=False, default=0)
+    stars_4 = db.Column(db.Integer, nullable=False, default=0)
+    stars_5 = db.Column(db.Integer, nullable=False, default=0)
+
+    # returns dictionary title, count, average, histogram (rating -> count)
+    def read(self):
+        return {
+            "title": self.title,
+            "count": self.count,
+            "average": round(self.total / self.count, 2) if self.count else None,
+            "histogram": {str(stars): getattr(self, f'stars_{stars}') for stars in RATINGS},
+        }
+
+
+# Adds one rating to the title's aggregate inside the current transaction, one upsert
+def addToStats(title, rating):
+    columns = ', '.join(f'stars_{stars}' for stars in RATINGS)
+    values = ', '.join(f':stars_{stars}' for stars in RATINGS)
+    updates = ', '.join(f'stars_{stars} = stars_{stars} + excluded.stars_{stars}' for stars in RATINGS)
+    db.session.execute(text(
+        f"INSERT INTO review_stats (title, count, total, {columns}) VALUES (:title, 1, :rating, {values}) "
+        f"ON CONFLICT (title) DO UPDATE SET count = count + 1, total = total + excluded.total, {updates}"),
+        {"title": title, "rating": rating, **{f'stars_{stars}': int(stars == rating) for stars in RATINGS}})
+
+
+# Aggregate of one title
+# returns dictionary (see ReviewStats.read) or None when the title has no reviews
+def reviewSummary(title):
+    stats = db.session.get(ReviewStats, title)
+    return stats.read() if stats else None
 
 
 # Define the function to initialize the database with sample data
 def initReviews():
-    with db.session() as session:
-        # Create some sample reviews
-        review1 = Review(title='Product A', review='This is a great product.')
-        review2 = Review(title='Service B', review='Excellent service provided.')
-        review3 = Review(title='Experience C', review='Had a wonderful experience.')
-
-        # Add reviews to the session and commit changes
-        session.add(review1)
-        session.add(review2)
-        session.add(review3)
-        session.commit()
+    with app.app_context():
+        """Create database and tables"""
+        db.create_all()
+        if Review.query.first() is not None:
+            return  # reviews have no unique key, seed only once
+        """Tester data for table"""
+        reviews = [
+            Review(title='Product A', review='This is a great product.', rating=5),
+            Review(title='Service B', review='Excellent service provided.', rating=4),
+            Review(title='Experience C', review='Had a wonderful experience.', rating=5),
+        ]
+        for review in reviews:
+            review.create()
@@ -1,13 +1,20 @@
 """ database dependencies to support sqliteDB examples """
+import calendar
 import datetime
 from random import randrange
 from datetime import date, datetime
 import os, base64
 import json
+import re
 
 from __init__ import app, db
+from model.zipcodes import zipcodeLocation, distanceMiles, boundingBox
+from model.versions import touch
+from hash_pool import hash_pool, needsRehash, PoolSaturated
+from principal_cache import principal_cache
+from sqlalchemy import event as sa_event, text
 from sqlalchemy.exc import IntegrityError
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash
 
 
 ''' Tutorial: https://www.sqlalchemy.org/library.html#tutorials, try to get into Python shell and follow along '''
@@ -15,6 +22,13 @@ from werkzeug.security import generate_password_hash, check_password_hash
 # Define the Event class to manage actions in 'events' table,  with a relationship to 'users' table
 class Event(db.Model):
     __tablename__ = 'events'
+    # composite indexes so date range, age group and calendar queries are index range seeks
+    # -- open events are userID IS NULL, so userID leads (this also serves per-user lookups)
+    __table_args__ = (
+        db.Index('ix_events_user_date', 'userID', 'date'),
+        db.Index('ix_events_user_agegroup_date', 'userID', 'agegroup', 'date'),
+        db.Index('ix_events_user_location', 'userID', 'lat', 'lon'),  # open events at one point, in id order
+    )
 
     # Define the Events schema
     id = db.Column(db.Integer, primary_key=True)
@@ -23,7 +37,10 @@ class Event(db.Model):
     address = db.Column(db.String, unique=False)
     zipcode = db.Column(db.Integer, unique=False)
     date = db.Column(db.Date, unique=False)
-    agegroup = db.Column(db.String, unique=False)
+    agegroup = db.Column(db.Integer, unique=False)  # minimum age in years
+    # zipcode centroid, kept in the events_geo R*Tree for radius search
+    lat = db.Column(db.Float, unique=False)
+    lon = db.Column(db.Float, unique=False)
 
     # Define a relationship in Schema to userID, many-to-one (many events to one user)
     userID = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -35,7 +52,25 @@ class Event(db.Model):
         self.address = address
         self.zipcode = zipcode
         self.date = date
-        self.agegroup = agegroup
+        self.agegroup = int(agegroup) if agegroup is not None else None
+        self.locate()
+
+    # sets lat/lon from the zipcode centroid, None when the zipcode is unknown
+    def locate(self):
+        location = zipcodeLocation(self.zipcode)
+        self.lat, self.lon = location if location else (None, None)
+
+    # read() keys -> columns each one needs, used to SELECT only what ?fields= asks for
+    READ_FIELDS = {
+        "id": ("id",),
+        "userID": ("userID",),
+        "title": ("title",),
+        "description": ("description",),
+        "address": ("address",),
+        "zipcode": ("zipcode",),
+        "date": ("date",),
+        "agegroup": ("agegroup",),
+    }
 
     # Returns a string representation of the Events object, similar to java toString()
     # returns string
@@ -48,6 +83,7 @@ class Event(db.Model):
         try:
             # creates a Events object from Events(db.Model) class, passes initializers
             db.session.add(self)  # add prepares to persist person object to Events table
+            touch('events')  # new version for conditional GETs
             db.session.commit()  # SqlAlchemy "unit of work pattern" requires a manual commit
             return self
         except IntegrityError:
@@ -56,36 +92,38 @@ class Event(db.Model):
 
     # CRUD read, returns dictionary representation of Events object
     # returns dictionary
-    def read(self):
-        return {
-            "id": self.id,
-            "userID": self.userID,
-            "title": self.title,
-            "description": self.description,
-            "address": self.address,
-            "zipcode": self.zipcode,
-            "date": self.date,
-            "agegroup": self.agegroup
-            #"base64": str(file_encode)   
-        }
+    # fields limits the keys to the ones asked for, no other attribute is touched
+    def read(self, fields=None):
+        return {field: getattr(self, field) for field in (fields or Event.READ_FIELDS)}
     
-    # CRUD update: updates user name, password, phone
-    # returns self
-    def update(self, dictionary):
-        """only updates values with length"""
+    # Column values for an update dictionary, unknown keys are ignored
+    # a new zipcode also sets lat/lon, raises ValueError for a bad date, agegroup or unknown zipcode
+    # returns dictionary of attribute name -> value
+    @staticmethod
+    def columnValues(dictionary):
+        values = {}
         for key in dictionary:
-            if key == "userID":
-                self.userID = dictionary[key]
-            if key == "title":
-                self.title = dictionary[key]
-            if key == "address":
-                self.address = dictionary[key]
-            if key == "description":
-                self.description = dictionary[key]
+            if key in ("userID", "title", "address", "description"):
+                values[key] = dictionary[key]
             if key == "zipcode":
-                self.zipcode = dictionary[key]
+                location = zipcodeLocation(dictionary[key])
+                if location is None:
+                    raise ValueError(f'{dictionary[key]} is not a known US zip code')
+                values["zipcode"] = dictionary[key]
+                values["lat"], values["lon"] = location
             if key == "date":
-                self.date = datetime.strptime(dictionary[key],'%Y-%m-%d').date()
+                values["date"] = datetime.strptime(dictionary[key],'%Y-%m-%d').date()
+            if key == "agegroup":
+                values["agegroup"] = int(dictionary[key])
+        return values
+
+    # CRUD update: updates title, description, address, zipcode, date, agegroup, userID
+    # returns self
+    def update(self, dictionary):
+        """only updates values with length"""
+        for key, value in Event.columnValues(dictionary).items():
+            setattr(self, key, value)
+        touch('events')
         db.session.commit()
         return self
     
@@ -93,10 +131,179 @@ class Event(db.Model):
     # None
     def delete(self):
         db.session.delete(self)
+        touch('events')
         db.session.commit()
         return None
 
 
+# Event constructor arguments to column values for a Core INSERT, located like Event.locate()
+def eventValues(row):
+    location = zipcodeLocation(row['zipcode']) or (None, None)
+    return {**row, "zipcode": int(row['zipcode']), "agegroup": int(row['agegroup']),
+            "lat": location[0], "lon": location[1]}
+
+
+# Bulk insert for imports, one multi-row INSERT and one commit per call instead of one per event
+# rows are dictionaries of Event constructor arguments, triggers keep search and geo indexes current
+# returns number of rows inserted
+def insertEvents(rows):
+    values = [eventValues(row) for row in rows]
+    if values:
+        db.session.execute(db.insert(Event), values)
+        touch('events')
+        db.session.commit()
+    return len(values)
+
+
+# Bulk update in one transaction, patches with the same values share one UPDATE ... WHERE id IN (...)
+# patches is a list of (id, update dictionary) as accepted by Event.update
+# returns dictionary of id -> 'updated', 'not found' or an error message
+def updateEvents(patches):
+    results = {}
+    groups = {}  # column values -> ids
+    for id, dictionary in patches:
+        try:
+            values = Event.columnValues(dictionary)
+            if not values:
+                raise ValueError('nothing to update')
+            groups.setdefault(tuple(sorted(values.items())), []).append(id)
+        except (TypeError, ValueError) as e:
+            results[id] = f'Invalid data: {e}'
+
+    for values, ids in groups.items():
+        for start in range(0, len(ids), 500):  # stay under SQLite's bound variable limit
+            chunk = ids[start:start + 500]
+            found = set(db.session.scalars(db.select(Event.id).where(Event.id.in_(chunk))))
+            if found:
+                db.session.execute(db.update(Event).where(Event.id.in_(found)).values(dict(values))
+                                   .execution_options(synchronize_session=False))
+            for id in chunk:
+                results[id] = 'updated' if id in found else 'not found'
+
+    if groups:
+        touch('events')
+    db.session.commit()
+    return results
+
+
+# Full-text search over events
+# -- events_fts is an SQLite FTS5 index over title, description and address, content lives in 'events'
+# -- triggers keep the index in sync on insert, update and delete, so writes need no extra code
+EVENT_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(
+        title, description, address,
+        content='events', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS events_fts_ai AFTER INSERT ON events BEGIN
+        INSERT INTO events_fts(rowid, title, description, address)
+        VALUES (new.id, new.title, new.description, new.address);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS events_fts_ad AFTER DELETE ON events BEGIN
+        INSERT INTO events_fts(events_fts, rowid, title, description, address)
+        VALUES ('delete', old.id, old.title, old.description, old.address);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS events_fts_au AFTER UPDATE OF title, description, address ON events BEGIN
+        INSERT INTO events_fts(events_fts, rowid, title, description, address)
+        VALUES ('delete', old.id, old.title, old.description, old.address);
+        INSERT INTO events_fts(rowid, title, description, address)
+        VALUES (new.id, new.title, new.description, new.address);
+    END""",
+]
+
+# Radius search over events
+# -- events_geo is an SQLite R*Tree holding each located event as a point (min == max)
+# -- a bounding box lookup returns the candidates, exact distance is computed on those only
+EVENT_GEO_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS events_geo USING rtree(id, min_lat, max_lat, min_lon, max_lon)",
+    """CREATE TRIGGER IF NOT EXISTS events_geo_ai AFTER INSERT ON events WHEN new.lat IS NOT NULL BEGIN
+        INSERT INTO events_geo VALUES (new.id, new.lat, new.lat, new.lon, new.lon);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS events_geo_ad AFTER DELETE ON events BEGIN
+        DELETE FROM events_geo WHERE id = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS events_geo_au AFTER UPDATE OF lat, lon ON events BEGIN
+        DELETE FROM events_geo WHERE id = old.id;
+        INSERT INTO events_geo SELECT new.id, new.lat, new.lat, new.lon, new.lon WHERE new.lat IS NOT NULL;
+    END""",
+]
+
+# Creates the search and geo indexes and triggers if missing, indexes existing events the first time
+def initEventIndexes(connection):
+    existing = {row[0] for row in connection.execute(text(
+        "SELECT name FROM sqlite_master WHERE name IN ('events_fts', 'events_geo')"))}
+    for statement in EVENT_SEARCH_DDL + EVENT_GEO_DDL:
+        connection.execute(text(statement))
+    if 'events_fts' not in existing:
+        connection.execute(text("INSERT INTO events_fts(events_fts) VALUES ('rebuild')"))
+    if 'events_geo' not in existing:
+        connection.execute(text(
+            "INSERT OR IGNORE INTO events_geo SELECT id, lat, lat, lon, lon FROM events WHERE lat IS NOT NULL"))
+    # events stored before lat/lon existed or before the zipcode table knew their zipcode,
+    # the update trigger adds them to events_geo
+    unlocated = connection.execute(text("SELECT id, zipcode FROM events WHERE lat IS NULL")).all()
+    located = [{"id": id, "lat": location[0], "lon": location[1]}
+               for id, location in ((id, zipcodeLocation(zipcode)) for id, zipcode in unlocated) if location]
+    if located:
+        connection.execute(text("UPDATE events SET lat = :lat, lon = :lon WHERE id = :id"), located)
+
+# db.create_all() builds the indexes together with a new events table
+sa_event.listen(Event.__table__, 'after_create', lambda target, connection, **kw: initEventIndexes(connection))
+
+# Ranked search over open events (no userID), every word in the query is a prefix match, best bm25 score first
+# title matches weigh more than description, description more than address
+# returns list of Event objects
+def searchEvents(query, limit=20, offset=0):
+    terms = re.findall(r'\w+', query.lower())
+    if not terms:
+        return []
+    match = ' '.join(f'"{term}"*' for term in terms)
+    statement = text("""
+        SELECT events.* FROM events_fts JOIN events ON events.id = events_fts.rowid
+        WHERE events_fts MATCH :match AND events."userID" IS NULL
+        ORDER BY bm25(events_fts, 10.0, 2.0, 1.0)
+        LIMIT :limit OFFSET :offset""")
+    return db.session.query(Event).from_statement(statement).params(match=match, limit=limit, offset=offset).all()
+
+# Number of open events (no userID) on each day of a month, optionally for one age group
+# returns dictionary of 'yyyy-mm-dd' -> count, days without events are left out
+def eventCalendar(year, month, agegroup=None):
+    first = date(year, month, 1)
+    last = date(year, month, calendar.monthrange(year, month)[1])  # no next month to compute, works for 9999-12
+    query = db.session.query(Event.date, db.func.count()).filter(
+        Event.userID.is_(None), Event.date >= first, Event.date <= last)
+    if agegroup is not None:
+        query = query.filter(Event.agegroup == agegroup)
+    return {day.isoformat(): count for day, count in query.group_by(Event.date)}
+
+# Open events (no userID) within miles of a point, nearest first
+# events sit on zipcode centroids, so many share a point: the R*Tree gives the open event count per distinct point
+# in the bounding box, distances are computed per point, and only the first limit events of the nearest points
+# are read (ix_events_user_location) and loaded
+# returns list of (Event, distance in miles)
+def nearbyEvents(lat, lon, miles, limit=50):
+    min_lat, max_lat, min_lon, max_lon = boundingBox(lat, lon, miles)
+    # '+' keeps SQLite from reading every open event through the userID index instead of the R*Tree
+    points = db.session.execute(text("""
+        SELECT events.lat, events.lon, COUNT(*) FROM events_geo JOIN events ON events.id = events_geo.id
+        WHERE events_geo.min_lat <= :max_lat AND events_geo.max_lat >= :min_lat
+          AND events_geo.min_lon <= :max_lon AND events_geo.max_lon >= :min_lon
+          AND +events."userID" IS NULL
+        GROUP BY events.lat, events.lon"""),
+        dict(min_lat=min_lat, max_lat=max_lat, min_lon=min_lon, max_lon=max_lon)).all()
+    points = sorted((distanceMiles(lat, lon, point_lat, point_lon), point_lat, point_lon)
+                    for point_lat, point_lon, count in points)
+
+    ranked = []  # (id, distance)
+    for distance, point_lat, point_lon in points:
+        if distance > miles or len(ranked) >= limit:
+            break
+        ids = db.session.scalars(db.select(Event.id).where(
+            Event.userID.is_(None), Event.lat == point_lat, Event.lon == point_lon).order_by(Event.id)
+            .limit(limit - len(ranked)))
+        ranked.extend((id, distance) for id in ids)
+    events = {event.id: event for event in db.session.scalars(db.select(Event).where(Event.id.in_([id for id, _ in ranked])))}
+    return [(events[id], distance) for id, distance in ranked]
+
+
 # Define the User class to manage actions in the 'users' table
 # -- Object Relational Mapping (ORM) is the key concept of SQLAlchemy
 # -- a.) db.Model is like an inner layer of the onion in ORM
@@ -115,6 +322,23 @@ class User(db.Model):
     
     # Defines a relationship between User record and Events table, one-to-many (one user to many Events)
     events = db.relationship("Event", cascade='all, delete', backref='users', lazy=True)
+    # number of events, a correlated COUNT on the userID index computed inside the users SELECT
+    # deferred: only loaded when a query asks for it with undefer() or load_only()
+    event_count = db.column_property(
+        db.select(db.func.count(Event.id)).where(Event.userID == id).correlate_except(Event).scalar_subquery(),
+        deferred=True)
+
+    # read() keys -> columns each one needs, used to SELECT only what ?fields= asks for
+    READ_FIELDS = {
+        "id": ("id",),
+        "name": ("_name",),
+        "uid": ("_uid",),
+        "dob": ("_dob",),
+        "age": ("_dob",),
+        "events": (),  # relationship, loaded separately
+        "event_count": ("event_count",),
+    }
+    DEFAULT_FIELDS = ("id", "name", "uid", "dob", "age", "events")
 
     # constructor of a User object, initializes the instance variables within object (self)
     def __init__(self, name, uid, password="123qwerty", dob=date.today(),role='User'):
@@ -160,13 +384,27 @@ class User(db.Model):
     # update password, this is conventional setter
     def set_password(self, password):
         """Create a hashed password."""
-        self._password = generate_password_hash(password, "pbkdf2:sha256", salt_length=10)
+        self._password = generate_password_hash(password, app.config['PASSWORD_HASH_METHOD'], salt_length=10)
 
     # check password parameter versus stored/encrypted password
+    # runs on the hash pool, raises PoolSaturated when the pool is full or too slow
     def is_password(self, password):
         """Check against hashed password."""
-        result = check_password_hash(self._password, password)
+        result = hash_pool.verify(self._password, password)
         return result
+
+    # after a successful login, re-hash a password stored with a weaker method/cost
+    # returns True when the stored hash was replaced
+    def rehash_password(self, password):
+        if not needsRehash(self._password):
+            return False
+        try:
+            self._password = hash_pool.generate(password)
+        except PoolSaturated:
+            return False  # try again at the next login
+        touch('users')
+        db.session.commit()
+        return True
     
     # dob property is returned as string, to avoid unfriendly outcomes
     @property
@@ -195,6 +433,7 @@ class User(db.Model):
         try:
             # creates a person object from User(db.Model) class, passes initializers
             db.session.add(self)  # add prepares to persist person object to Users table
+            touch('users', 'events')  # new user may come with events
             db.session.commit()  # SqlAlchemy "unit of work pattern" requires a manual commit
             return self
         except IntegrityError:
@@ -203,20 +442,19 @@ class User(db.Model):
 
     # CRUD read converts self to dictionary
     # returns dictionary
-    def read(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "uid": self.uid,
-            "dob": self.dob,
-            "age": self.age,
-            "events": [event.read() for event in self.events]
-        }
+    # fields limits the keys to the ones asked for, events are only loaded when asked for
+    def read(self, fields=None):
+        fields = fields or User.DEFAULT_FIELDS
+        data = {field: getattr(self, field) for field in fields if field != "events"}
+        if "events" in fields:
+            data["events"] = [event.read() for event in self.events]
+        return data
 
     # CRUD update: updates user name, password, phone
     # returns self
     def update(self, dictionary):
         """only updates values with length"""
+        uid = self._uid
         for key in dictionary:
             if key == "name":
                 self.name = dictionary[key]
@@ -224,17 +462,50 @@ class User(db.Model):
                 self.uid = dictionary[key]
             if key == "password":
                 self.set_password(dictionary[key])
+        touch('users', 'principals')  # 'principals' tells other workers to drop their cached logins
         db.session.commit()
+        principal_cache.invalidate(uid)  # cached logins of this user see the change
         return self
 
     # CRUD delete: remove self
     # None
     def delete(self):
         db.session.delete(self)
+        touch('users', 'events', 'principals')  # user's events are deleted with it
         db.session.commit()
+        principal_cache.invalidate(self._uid)  # revoke cached logins
         return None
 
 
+# Uids of rows to import that are already taken
+# returns set of uids
+def existingUids(uids):
+    uids = list(uids)
+    taken = set()
+    for start in range(0, len(uids), 500):  # keeps the IN list under SQLite's variable limit
+        taken.update(db.session.scalars(db.select(User._uid).where(User._uid.in_(uids[start:start + 500]))))
+    return taken
+
+
+# Bulk insert for user imports, one multi-row INSERT for users and one for their events, one commit
+# rows are dictionaries of users columns (_name, _uid, _password already hashed, _dob, _role)
+# with an 'events' list of Event constructor arguments
+# returns number of users inserted, raises IntegrityError (nothing saved) when a uid is taken
+def insertUsers(rows):
+    users = [{key: value for key, value in row.items() if key != 'events'} for row in rows]
+    if not users:
+        return 0
+    db.session.execute(db.insert(User), users)
+    ids = dict(db.session.execute(
+        db.select(User._uid, User.id).where(User._uid.in_([user['_uid'] for user in users]))).all())
+    events = [{**eventValues(event), "userID": ids[row['_uid']]} for row in rows for event in row.get('events', ())]
+    if events:
+        db.session.execute(db.insert(Event), events)
+    touch('users', 'events')
+    db.session.commit()
+    return len(users)
+
+
 """Database Creation and Testing """
 
 
@@ -243,6 +514,8 @@ def initUsers():
     with app.app_context():
         """Create database and tables"""
         db.create_all()
+        with db.engine.begin() as connection:
+            initEventIndexes(connection)  # databases created before the search and geo indexes
         """Tester data for table"""
         u1 = User(name='Thomas Edison', uid='toby', password='123toby', dob=date(1847, 2, 11))
         u2 = User(name='Nicholas Tesla', uid='niko', password='123niko', dob=date(1856, 7, 10))
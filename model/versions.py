@@ -0,0 +1,34 @@
+""" Per-table version counters, bumped by every write, read by conditional GETs (ETag) """
+from __init__ import db
+from sqlalchemy import text
+
+
+# Define the TableVersion class to manage the 'table_versions' table, one row per versioned table
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"TableVersion({self.name},{self.version})"
+
+
+# Bumps the version of each table inside the current transaction, call before db.session.commit()
+# -- a rolled back write rolls back its bump too
+# returns dictionary of table name -> new version
+def touch(*names):
+    versions = {}
+    for name in names:
+        versions[name] = db.session.execute(text(
+            "INSERT INTO table_versions (name, version) VALUES (:name, 1) "
+            "ON CONFLICT (name) DO UPDATE SET version = version + 1 RETURNING version"), {"name": name}).scalar()
+    db.session.info.setdefault('touched', set()).update(names)
+    return versions
+
+
+# Current versions in the order asked, 0 for tables never written, one indexed SELECT
+# returns tuple of int
+def getVersions(*names):
+    rows = dict(db.session.query(TableVersion.name, TableVersion.version).filter(TableVersion.name.in_(names)))
+    return tuple(rows.get(name, 0) for name in names)
@@ -0,0 +1,52 @@
+""" Zipcode centroids and distance math for radius search
+
+zipcodes.csv lists every US zip code (standard, PO box, unique and military) with its centroid,
+coordinates from GeoNames (https://www.geonames.org, CC BY 4.0)
+"""
+import csv
+import math
+import os
+
+# zipcode,lat,lon per line, zipcodes keep their leading zeros in the file
+ZIPCODE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'zipcodes.csv')
+EARTH_RADIUS_MILES = 3958.8
+
+_centroids = None
+
+
+# Loads the centroid table once per process
+# returns dictionary of int zipcode -> (lat, lon)
+def getCentroids():
+    global _centroids
+    if _centroids is None:
+        centroids = {}
+        with open(ZIPCODE_FILE, newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                centroids[int(row['zipcode'])] = (float(row['lat']), float(row['lon']))
+        _centroids = centroids
+    return _centroids
+
+
+# Centroid of a zipcode, accepts int or string ("02130")
+# returns (lat, lon) or None for unknown or invalid zipcodes
+def zipcodeLocation(zipcode):
+    try:
+        return getCentroids().get(int(zipcode))
+    except (TypeError, ValueError):
+        return None
+
+
+# Great circle distance in miles
+def distanceMiles(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+
+# Smallest lat/lon box containing every point within miles of (lat, lon)
+# returns (min_lat, max_lat, min_lon, max_lon)
+def boundingBox(lat, lon, miles):
+    dlat = math.degrees(miles / EARTH_RADIUS_MILES)
+    cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 89.9)))  # widest point of the box
+    dlon = min(math.degrees(miles / (EARTH_RADIUS_MILES * cos_lat)), 180.0)
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
@@ -0,0 +1,83 @@
+""" Short lived cache of authenticated principals, keyed by JWT, used by token_required
+
+Saves the users lookup on every protected request. Entries live PRINCIPAL_CACHE_TTL seconds;
+User.update and User.delete drop the entries of that user (role change, password change,
+removal) in this worker and bump the 'principals' table version. Every worker compares that
+version at most once per PRINCIPAL_CACHE_CHECK seconds and empties its cache when it moved,
+so a revoked login is trusted by other workers for at most PRINCIPAL_CACHE_CHECK seconds.
+"""
+from collections import OrderedDict, namedtuple
+import threading
+import time
+
+from __init__ import app
+from model.versions import getVersions
+
+# what token_required hands to the endpoint as current_user
+Principal = namedtuple('Principal', ['id', 'uid', 'name', 'role'])
+
+
+class PrincipalCache:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # token -> (expires, principal), oldest first
+        self._tokens = {}  # uid -> set of tokens, for invalidation
+        self._version = None  # 'principals' version the entries were cached under
+        self._checked = 0  # time of the last version check
+
+    # empties the cache when another worker changed or removed a user since the last check
+    def _sync(self):
+        now = time.monotonic()
+        if now - self._checked < app.config['PRINCIPAL_CACHE_CHECK']:
+            return
+        version = getVersions('principals')[0]
+        with self._lock:
+            self._checked = now
+            if version != self._version:
+                self._entries.clear()
+                self._tokens.clear()
+                self._version = version
+
+    def get(self, token):
+        self._sync()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(token)
+                return None
+            return entry[1]
+
+    def set(self, token, principal, ttl=None):
+        expires = time.monotonic() + (ttl or app.config['PRINCIPAL_CACHE_TTL'])
+        with self._lock:
+            if token in self._entries:
+                self._remove(token)
+            self._entries[token] = (expires, principal)
+            self._tokens.setdefault(principal.uid, set()).add(token)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    # forget every token of a user, call when the user's role, password or existence changes
+    def invalidate(self, uid):
+        with self._lock:
+            for token in self._tokens.pop(uid, ()):
+                self._entries.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens.clear()
+
+    def _remove(self, token):
+        expires, principal = self._entries.pop(token)
+        tokens = self._tokens.get(principal.uid)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens[principal.uid]
+
+
+principal_cache = PrincipalCache()
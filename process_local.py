@@ -0,0 +1,176 @@
+""" State that belongs to one worker process, never used through fork (gunicorn forks workers after import)
+
+-- ProcessLocal: a value made on first use in each process (process pools, HTTP sessions, flush threads)
+-- LocalSQLite: a connection per thread and process to a local SQLite file shared by every worker
+   on the host, WAL so readers never wait for a writer
+-- WriteBehind: counts summed in memory per key and written by a background thread of each process
+"""
+import atexit
+import os
+import sqlite3
+import threading
+
+from __init__ import app
+
+
+class ProcessLocal:
+    # factory() makes the value, it runs once per process, under a lock
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._pid = None
+
+    # the value of this process, made the first time
+    def get(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._value = self._factory()
+                self._pid = os.getpid()
+            return self._value
+
+    # the value made in this process, None when there is none (nothing to flush or shut down here)
+    def peek(self):
+        return self._value if self._pid == os.getpid() else None
+
+    # forgets value if it is still the one of this process (not replaced already by another thread)
+    # returns True when it was forgotten
+    def discard(self, value):
+        with self._lock:
+            if self._pid != os.getpid() or self._value is not value:
+                return False
+            self._value = self._pid = None
+            return True
+
+    # forgets the value, the next get() makes a new one
+    # returns the value made in this process or None
+    def reset(self):
+        with self._lock:
+            value = self.peek()
+            self._value = self._pid = None
+            return value
+
+
+class LocalSQLite:
+    # schema is a list of statements run on each new connection (CREATE ... IF NOT EXISTS)
+    # durable False turns syncing off, for state that may be lost on power loss (caches, limiters)
+    def __init__(self, path, schema=(), durable=False):
+        self.path = path
+        self.schema = schema
+        self.durable = durable
+        self._local = threading.local()  # sqlite3 connections are per thread
+
+    # connection in autocommit mode, opened on first use in each thread and process
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            if not self.durable:
+                connection.execute("PRAGMA synchronous = OFF")
+            for statement in self.schema:
+                connection.execute(statement)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+
+# Write-behind buffer: changes are summed in memory per key, a background thread hands them to write()
+# every interval seconds (or sooner when max_pending keys wait), one batch per flush
+# -- add() is a dictionary update under a lock, nothing waits for the database
+# -- the thread starts on first use in each process; changes copied through fork are the parent's to write
+# -- a batch that fails to write goes back into pending and is retried at the next flush
+# -- pending changes are flushed when the process exits normally, a killed process loses at most one interval
+# subclasses supply write(batch) and may extend forked() and written()
+class WriteBehind:
+    # name names the thread, interval_config the app.config key of the default interval in seconds
+    def __init__(self, name, interval_config, interval=None, max_pending=10000):
+        self.name = name
+        self._interval_config = interval_config
+        self._interval = interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> list of counts, not written yet
+        self._flushing = {}  # the batch being written
+        self._wake = threading.Event()
+        self._thread = ProcessLocal(self._start)
+        atexit.register(self._flushAtExit)
+
+    @property
+    def interval(self):
+        return self._interval or app.config[self._interval_config]
+
+    # runs once per process through self._thread, with self._lock held by the caller of _begin()
+    def _start(self):
+        self._pending, self._flushing = {}, {}
+        self.forked()
+        thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        thread.start()
+        return thread
+
+    # caller holds the lock, starts the flush thread of this process if needed
+    def _begin(self):
+        self._thread.get()
+
+    # caller holds the lock, adds counts (a sequence of numbers) to key's pending counts
+    def _add(self, key, counts):
+        self._begin()
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = list(counts)
+        else:
+            for i, count in enumerate(counts):
+                entry[i] += count
+        if len(self._pending) >= self.max_pending:
+            self._wake.set()  # flush early rather than grow without bound
+
+    def add(self, key, counts):
+        with self._lock:
+            self._add(key, counts)
+
+    # hook, state of this object copied through fork is reset here (caller holds the lock)
+    def forked(self):
+        pass
+
+    # writes batch (dictionary key -> counts) in one transaction, raises when nothing was written
+    # returns what flush() returns
+    def write(self, batch):
+        raise NotImplementedError
+
+    # hook, runs after every successful flush, the batch is done being written
+    def written(self):
+        with self._lock:
+            self._flushing = {}
+
+    # writes the pending changes now
+    # returns what write() returned, 0 when nothing was pending
+    def flush(self):
+        with self._lock:
+            batch = self._flushing = self._pending
+            self._pending = {}
+        result = 0
+        if batch:
+            try:
+                result = self.write(batch)
+            except Exception:
+                with self._lock:
+                    for key, counts in batch.items():
+                        self._add(key, counts)
+                    self._flushing = {}
+                raise
+        self.written()
+        return result
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception(f'{self.name} flush failed, retrying')
+
+    def _flushAtExit(self):
+        if self._thread.peek() is not None:
+            self.flush()
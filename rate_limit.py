@@ -0,0 +1,126 @@
+""" Token bucket rate limiting, checked before any expensive work (password hashing)
+
+Each key (e.g. 'ip:1.2.3.4' or 'uid:toby') has a bucket of up to burst tokens refilled at rate
+tokens per second; a request takes one token, an empty bucket means 429.
+-- MemoryBuckets: per worker process, no I/O
+-- SQLiteBuckets: one local SQLite file shared by every gunicorn worker on the host
+"""
+import math
+import os
+import random
+import threading
+import time
+
+from __init__ import app
+from process_local import LocalSQLite
+
+
+# refill a bucket read at updated with tokens left, then try to take one
+# returns (tokens left, seconds until a token is available or 0 when allowed)
+def _take(tokens, updated, now, rate, burst):
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBuckets:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = {}  # key -> (tokens, updated, time the bucket is full again)
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+            tokens, wait = _take(tokens, updated, now, rate, burst)
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        return wait
+
+    # buckets that have refilled completely carry no state, drop them
+    def _prune(self, now):
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[2] > now}
+
+
+class SQLiteBuckets:
+    def __init__(self, path):
+        self.path = path
+        # limiter state may be lost on power loss, not durable
+        self._store = LocalSQLite(path, ["CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL, full REAL)"])
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        connection = self._store.connection()
+        connection.execute("BEGIN IMMEDIATE")  # serializes read-modify-write across workers
+        try:
+            row = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens, wait = _take(tokens, updated, now, rate, burst)
+            connection.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                               (key, tokens, now, now + (burst - tokens) / rate))
+            if random.random() < 0.001:  # now and then drop buckets that have refilled completely
+                connection.execute("DELETE FROM buckets WHERE full < ?", (now,))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return wait
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, store):
+        self.rate = rate
+        self.burst = burst
+        self.store = store
+
+    # takes a token for key, returns 0 when allowed, otherwise seconds to wait
+    def take(self, key):
+        return self.store.take(key, self.rate, self.burst)
+
+
+_limiters = None
+
+
+def _loginLimiters():
+    global _limiters
+    if _limiters is None:
+        path = app.config['RATE_LIMIT_STORE']
+        store = SQLiteBuckets(path) if path else MemoryBuckets()
+        _limiters = (TokenBucketLimiter(*app.config['LOGIN_RATE_PER_IP'], store),
+                     TokenBucketLimiter(*app.config['LOGIN_RATE_PER_UID'], store))
+    return _limiters
+
+
+# Login attempt budget per client ip and per user id
+# returns 0 when the attempt may go ahead, otherwise whole seconds for Retry-After
+def loginRetryAfter(uid, ip):
+    by_ip, by_uid = _loginLimiters()
+    wait = by_ip.take(f'ip:{ip}') or by_uid.take(f'uid:{uid}')
+    return math.ceil(wait)
+
+
+"""Benchmark
+  python rate_limit.py [checks]
+  limiter overhead per login attempt for each store, next to the pbkdf2 check it protects
+"""
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    from werkzeug.security import check_password_hash, generate_password_hash
+
+    checks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    pwhash = generate_password_hash('123toby', app.config['PASSWORD_HASH_METHOD'], 10)
+    start = time.perf_counter()
+    check_password_hash(pwhash, '123toby')
+    print(f"pbkdf2 check:   {(time.perf_counter() - start) * 1e6:10.1f} us")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, store in (('memory', MemoryBuckets()), ('sqlite', SQLiteBuckets(os.path.join(directory, 'rl.db')))):
+            limiter = TokenBucketLimiter(1e9, 1e9, store)  # never limits, measures the bookkeeping only
+            start = time.perf_counter()
+            for i in range(checks):
+                limiter.take(f'ip:10.0.{i % 256}.{i % 100}')
+            print(f"{name} bucket: {(time.perf_counter() - start) / checks * 1e6:10.1f} us per check")
@@ -0,0 +1,90 @@
+""" Response cache shared by every worker process, stored in a local SQLite file
+
+Entries are serialized GET responses tagged with the tables they were built from.
+-- LRU: when there are more than max_entries rows the least recently used are evicted
+-- TTL: entries older than their ttl are ignored and removed
+-- invalidation: invalidate('events') deletes every entry tagged events, because the file is
+   shared the eviction is seen by all workers at once; models call it after commit (see below)
+"""
+import json
+import time
+
+from sqlalchemy import event as sa_event
+from sqlalchemy.orm import Session
+
+from __init__ import app
+from process_local import LocalSQLite
+
+
+class ResponseCache:
+    def __init__(self, path=None, max_entries=2000, ttl=300):
+        self._path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._store = None
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = app.config['RESPONSE_CACHE_PATH']
+        return self._path
+
+    def _connection(self):
+        if self._store is None:  # losing the cache on power loss is fine, not durable
+            self._store = LocalSQLite(self.path, [
+                """CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, tags TEXT NOT NULL, mimetype TEXT, headers TEXT, body BLOB NOT NULL,
+                expires REAL NOT NULL, used REAL NOT NULL)""",
+                "CREATE INDEX IF NOT EXISTS ix_entries_used ON entries (used)",
+            ])
+        return self._store.connection()
+
+    # returns (body, mimetype, headers dictionary) or None
+    def get(self, key):
+        connection = self._connection()
+        row = connection.execute("SELECT body, mimetype, headers, expires, used FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        body, mimetype, headers, expires, used = row
+        now = time.time()
+        if expires < now:
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+        if now - used > 1:  # refresh LRU position at most once a second per entry
+            connection.execute("UPDATE entries SET used = ? WHERE key = ?", (now, key))
+        return body, mimetype, json.loads(headers)
+
+    def set(self, key, body, mimetype, tags, headers=None, ttl=None):
+        now = time.time()
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (key, ',' + ','.join(tags) + ',', mimetype, json.dumps(headers or {}), body,
+                            now + (ttl or self.ttl), now))
+        connection.execute("DELETE FROM entries WHERE key IN "
+                           "(SELECT key FROM entries ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    # removes every entry built from any of the tables
+    def invalidate(self, *tags):
+        connection = self._connection()
+        for tag in tags:
+            connection.execute("DELETE FROM entries WHERE tags LIKE ?", (f'%,{tag},%',))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM entries")
+
+
+response_cache = ResponseCache()
+
+
+# model writes call model.versions.touch(), which records the tables in session.info
+# once the transaction is committed, entries built from those tables are evicted in every worker
+@sa_event.listens_for(Session, 'after_commit')
+def _invalidate_touched(session):
+    touched = session.info.pop('touched', None)
+    if touched:
+        response_cache.invalidate(*touched)
+
+
+@sa_event.listens_for(Session, 'after_rollback')
+def _forget_touched(session):
+    session.info.pop('touched', None)